@@ -0,0 +1,50 @@
+import os
+import threading
+
+from hyundai_kia_connect_api import VehicleManager
+
+
+class Account:
+    """
+    Kia Connect / Bluelink account
+    Role:
+    - hold the VehicleManager (and so the login token) shared by all the vehicles of the account
+    - define the daily API budget of the account: the rate limit applies per account, not per vehicle
+    """
+
+    def __init__(self, name: str, username: str, password: str, pin: str = "", region: int = 1, brand: int = 1,
+                 daily_api_budget: int = 200):
+        """
+        :param name: name used to count API calls in the database
+        :param region: 1: Europe, 2: Canada, 3: USA, 4: China, 5: Australia
+        :param brand: 1: Kia, 2: Hyundai, 3: Genesis
+        :param daily_api_budget: maximum number of API calls per day, cached calls included
+        """
+        self.name = name
+        self.daily_api_budget = daily_api_budget
+
+        # the VehicleManager is not thread safe. token refreshes are serialized between the account's vehicles.
+        self.lock = threading.Lock()
+
+        self.vm = VehicleManager(region=region, brand=brand, username=username, password=password, pin=pin)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Single account configuration, from the .env file
+        """
+        return cls(name=os.environ["KIA_USERNAME"],
+                   username=os.environ["KIA_USERNAME"],
+                   password=os.environ["KIA_PASSWORD"],
+                   region=int(os.environ.get("KIA_REGION") or 1),
+                   brand=int(os.environ.get("KIA_BRAND") or 1),
+                   daily_api_budget=int(os.environ.get("KIA_DAILY_API_BUDGET") or 200))
+
+    def check_and_refresh_token(self):
+        with self.lock:
+            if len(self.vm.vehicles) == 0 and self.vm.token:
+                # supposed bug in lib: if initialization fails due to rate limiting, vehicles list is never filled
+                # reset token to login again, the lib will then fill the list correctly
+                self.vm.token = None
+            # this command does NOT refresh vehicles (at least for EU and if there is not a preexisting token)
+            self.vm.check_and_refresh_token()
@@ -0,0 +1,205 @@
+import logging
+
+import numpy as np
+
+import DatabaseClient
+
+
+class ConsumptionAnalytics:
+    """
+    Consumption analytics
+    Role:
+    - load stats_per_day and trips of a vehicle as NumPy arrays
+    - compute, in batch, daily and rolling efficiency, climate and drivetrain energy shares,
+      seasonal (per month of year) efficiency and consumption per speed bucket
+    - materialize the results in tables read by Grafana, only rewriting the rows whose values changed
+    - after new daily stats or trips, recompute the daily rows from the earliest changed date only
+
+    Trips do not come with their energy use. Each trip is attributed a share of its day's consumption
+    proportional to its distance, which is exact for days with a single trip.
+    """
+
+    # materialized tables and their columns, in the order computed below
+    DAY_COLUMNS = ["unix_timestamp",
+                   "efficiency_kwh_100km",
+                   "efficiency_regen_deducted_kwh_100km",
+                   "climate_share_percent",
+                   "drivetrain_share_percent",
+                   "rolling_7d_efficiency_kwh_100km",
+                   "rolling_30d_efficiency_kwh_100km"]
+    MONTH_COLUMNS = ["distance_km", "efficiency_kwh_100km"]
+    SPEED_COLUMNS = ["trips", "distance_km", "driving_time_minutes", "estimated_kwh", "efficiency_kwh_100km"]
+
+    # source columns loaded from stats_per_day and trips
+    STATS_COLUMNS = ["date",
+                     "unix_timestamp",
+                     "total_consumed_kwh",
+                     "engine_consumption_kwh",
+                     "climate_consumption_kwh",
+                     "regenerated_energy_kwh",
+                     "distance"]
+    TRIPS_COLUMNS = ["date", "distance_km", "avg_speed_kmh", "driving_time_minutes"]
+
+    def __init__(self, db_client: DatabaseClient):
+        self.db_client = db_client
+
+        self.ROLLING_WINDOWS_DAYS = (7, 30)
+        self.SPEED_BUCKET_KMH = 10
+
+        self.loaded = False
+
+    def load(self):
+        """
+        Computes every day of a vehicle that has no materialized day yet (backfill)
+        """
+        self.loaded = True
+
+        if self.db_client.get_last_consumption_date() is None:
+            self.refresh()
+
+    def refresh(self, since_date: [str, None] = None):
+        """
+        Recomputes the metrics and saves the rows that changed
+        :param since_date: earliest date (YYYY-MM-DD) whose daily stats or trips changed. Daily rows before it are
+        left as they are. None: all days are recomputed
+        """
+        if not self.loaded:
+            self.load()
+
+        days = self.to_arrays(self.db_client.get_daily_stats(self.STATS_COLUMNS), self.STATS_COLUMNS)
+        if len(days["date"]) == 0:
+            return
+
+        trips = self.to_arrays(self.db_client.get_trips(self.TRIPS_COLUMNS), self.TRIPS_COLUMNS)
+
+        # the rolling windows of the recomputed days also read the days before since_date
+        window_days = days
+        first_saved_day = 0
+        if since_date is not None:
+            window_start = str(np.datetime64(since_date, "D") - (max(self.ROLLING_WINDOWS_DAYS) - 1))
+            first_window_day = np.searchsorted(days["date"], window_start)
+            window_days = {column: values[first_window_day:] for column, values in days.items()}
+            first_saved_day = np.searchsorted(window_days["date"], since_date)
+            if first_saved_day == len(window_days["date"]):
+                window_days = None
+
+        # month of year and speed aggregates span all years
+        per_month = self.compute_per_month_of_year(days)
+        per_speed = self.compute_per_speed(days, trips)
+
+        changed_days = 0
+        if window_days is not None:
+            per_day = self.compute_per_day(window_days)
+            changed_days = self.db_client.save_consumption_rows("consumption_per_day", "date", self.DAY_COLUMNS,
+                                                                window_days["date"][first_saved_day:],
+                                                                [column[first_saved_day:] for column in per_day],
+                                                                since_key=since_date)
+
+        self.db_client.save_consumption_rows("consumption_per_month_of_year", "month", self.MONTH_COLUMNS,
+                                             np.arange(1, 13), per_month)
+        self.db_client.save_consumption_rows("consumption_per_speed", "speed_bucket_kmh", self.SPEED_COLUMNS,
+                                             per_speed[0], per_speed[1:])
+
+        logging.debug(f"consumption analytics: {changed_days} days updated")
+
+    @staticmethod
+    def to_arrays(rows: list, columns: list) -> dict:
+        """
+        Converts rows to one array per column. NULL values become 0.
+        Dates are kept as YYYY-MM-DD strings (the time of trips is dropped).
+        """
+        arrays = {}
+        for i, column in enumerate(columns):
+            if column == "date":
+                arrays[column] = np.array([row[i][:10] for row in rows], dtype=str)
+            else:
+                arrays[column] = np.array([row[i] or 0 for row in rows], dtype=np.float64)
+
+        return arrays
+
+    @staticmethod
+    def ratio(numerator: np.ndarray, denominator: np.ndarray, factor: float = 1) -> np.ndarray:
+        """
+        Element-wise numerator / denominator * factor, NaN where the denominator is 0
+        """
+        result = np.full(numerator.shape, np.nan)
+        np.divide(numerator * factor, denominator, out=result, where=denominator > 0)
+        return result
+
+    def compute_per_day(self, days: dict) -> list:
+        total = days["total_consumed_kwh"]
+        distance = days["distance"]
+
+        columns = [days["unix_timestamp"],
+                   self.ratio(total, distance, 100),
+                   self.ratio(total - days["regenerated_energy_kwh"], distance, 100),
+                   self.ratio(days["climate_consumption_kwh"], total, 100),
+                   self.ratio(days["engine_consumption_kwh"], total, 100)]
+
+        # rolling windows over calendar days, including days without data: sums over a dense day range
+        day_numbers = days["date"].astype("datetime64[D]").astype(np.int64)
+        day_index = day_numbers - day_numbers.min()
+        dense_energy = np.zeros(day_index.max() + 1)
+        dense_distance = np.zeros(day_index.max() + 1)
+        np.add.at(dense_energy, day_index, total)
+        np.add.at(dense_distance, day_index, distance)
+        cumulative_energy = np.concatenate(([0], np.cumsum(dense_energy)))
+        cumulative_distance = np.concatenate(([0], np.cumsum(dense_distance)))
+
+        for window in self.ROLLING_WINDOWS_DAYS:
+            window_start = np.maximum(day_index + 1 - window, 0)
+            energy = cumulative_energy[day_index + 1] - cumulative_energy[window_start]
+            window_distance = cumulative_distance[day_index + 1] - cumulative_distance[window_start]
+            columns.append(self.ratio(energy, window_distance, 100))
+
+        return columns
+
+    def compute_per_month_of_year(self, days: dict) -> list:
+        """
+        Distance-weighted efficiency for each month of the year (index 0: january), all years together
+        """
+        month_index = days["date"].astype("datetime64[M]").astype(np.int64) % 12
+
+        distance = np.bincount(month_index, weights=days["distance"], minlength=12)
+        energy = np.bincount(month_index, weights=days["total_consumed_kwh"], minlength=12)
+
+        return [distance, self.ratio(energy, distance, 100)]
+
+    def compute_per_speed(self, days: dict, trips: dict) -> list:
+        """
+        Consumption histogram per average speed bucket
+        :return: [bucket lower bounds, then one array per SPEED_COLUMNS column]
+        """
+        if len(trips["date"]) == 0:
+            return [np.array([], dtype=np.int64)] + [np.array([]) for column in self.SPEED_COLUMNS]
+
+        # distance share of each trip in its day, then the day's energy split accordingly
+        trip_days, trip_day_index = np.unique(trips["date"], return_inverse=True)
+        day_trip_distance = np.bincount(trip_day_index, weights=trips["distance_km"])
+        distance_share = self.ratio(trips["distance_km"], day_trip_distance[trip_day_index])
+
+        day_position = np.searchsorted(days["date"], trip_days)
+        day_position = np.minimum(day_position, len(days["date"]) - 1)
+        has_stats = days["date"][day_position] == trip_days
+        day_energy = np.where(has_stats, days["total_consumed_kwh"][day_position], np.nan)
+
+        trip_energy = distance_share * day_energy[trip_day_index]
+        # trips on days without daily stats (or with 0 km) are left out of the energy totals
+        known = ~np.isnan(trip_energy)
+
+        buckets = (trips["avg_speed_kmh"] // self.SPEED_BUCKET_KMH).astype(np.int64)
+        bucket_count = buckets.max() + 1
+
+        trip_count = np.bincount(buckets, minlength=bucket_count)
+        distance = np.bincount(buckets, weights=trips["distance_km"], minlength=bucket_count)
+        driving_time = np.bincount(buckets, weights=trips["driving_time_minutes"], minlength=bucket_count)
+        energy = np.bincount(buckets[known], weights=trip_energy[known], minlength=bucket_count)
+        known_distance = np.bincount(buckets[known], weights=trips["distance_km"][known], minlength=bucket_count)
+
+        present = trip_count > 0
+        return [np.arange(bucket_count)[present] * self.SPEED_BUCKET_KMH,
+                trip_count[present],
+                distance[present],
+                driving_time[present],
+                energy[present],
+                self.ratio(energy, known_distance, 100)[present]]
@@ -1,15 +1,28 @@
 import datetime
+import glob
+import gzip
+import json
 import logging
 import os
+import re
+import shutil
 import sqlite3
+import tempfile
+import urllib.parse
 from sqlite3 import Connection
 
+from dateutil.relativedelta import relativedelta
+
 import VehicleClient
 from hyundai_kia_connect_api.Vehicle import TripInfo
 
 
 class DatabaseClient:
 
+    # version of the tables and columns created by migrate(), kept in the user_version of the database.
+    # increment it when a migration is added
+    SCHEMA_VERSION = 1
+
     def __init__(self, vehicle_client: VehicleClient):
         self.db_path = os.environ["KIA_DB_PATH"]
 
@@ -21,31 +34,126 @@ class DatabaseClient:
 
         self.vehicle_client = vehicle_client
 
-    def create_connection(self) -> Connection:
-        conn = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        # functions called after a log row has been saved (ex: to push server-sent events)
+        self.log_listeners = []
+
+        # in fleet mode, several vehicles write concurrently: wait this long for the lock instead of failing right away
+        self.BUSY_TIMEOUT = 30
+
+        # log rows older than the hot months are moved to one compressed, read-only SQLite file per month
+        self.archive_dir = os.environ.get("KIA_ARCHIVE_DIR") or os.path.join(os.path.dirname(self.db_path),
+                                                                            "archive")
+        # Grafana only shows the hot months: see archive_log.py
+        self.HOT_MONTHS = int(os.environ.get("KIA_HOT_MONTHS") or 24)
+        # temporary copies of the archives older than this were left behind by a process that stopped
+        self.STALE_ARCHIVE_COPY_SECONDS = 3600 * 24
+
+        # v2 databases (see compact_db.py) have a log view instead of a log table
+        self.log_is_view = None
+
+    def create_connection(self, include_archives: bool = False) -> Connection:
+        """
+        :param include_archives: attach the archived months and create the log_all view (hot + archived log rows)
+        """
+        conn = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                               uri=include_archives, timeout=self.BUSY_TIMEOUT)
+
+        if include_archives:
+            self.attach_archives(conn)
+
         return conn
 
+    def is_log_view(self, cur) -> bool:
+        if self.log_is_view is None:
+            cur.execute("SELECT type FROM sqlite_master WHERE name = 'log';")
+            self.log_is_view = cur.fetchone()[0] == 'view'
+
+        return self.log_is_view
+
+    def get_log_vehicle_filter(self, cur, table: str = "log") -> str:
+        """
+        Returns the SQL condition selecting the rows of the vehicle in a log table. Its parameter is the vehicle ID.
+        In v2 databases, the integer key of log_v2 is compared: it does not need the vehicle ID of each row.
+        """
+        # archived rows may have no vehicle key
+        if table == "log" and self.is_log_view(cur):
+            return "vehicle = (SELECT id FROM vehicles WHERE uuid = COALESCE(?, ''))"
+
+        return "vehicle_id = ?"
+
+    def get_log_key(self, cur) -> str:
+        """
+        Returns the SQL expression of the log_key column: see get_log_rows_since()
+        """
+        return "log.vehicle" if self.is_log_view(cur) else "log.rowid"
+
+    def migrate(self, default_vehicle_id: str):
+        """
+        Adds the columns and tables missing from databases created by older versions.
+        Runs on each daemon run: once done, it is skipped after a single query.
+        :param default_vehicle_id: see create_vehicle_id_columns()
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('PRAGMA user_version;')
+        if cur.fetchone()[0] >= self.SCHEMA_VERSION:
+            conn.close()
+            return
+
+        self.create_vehicle_id_columns(default_vehicle_id)
+        self.create_poll_model_tables()
+        self.create_consumption_tables()
+        self.create_prediction_tables()
+
+        cur.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION};')
+        conn.close()
+
+    def create_vehicle_id_columns(self, default_vehicle_id: str):
+        """
+        Adds the vehicle_id column to databases created before fleet mode.
+        Existing rows were all saved by a single vehicle, they are assigned to default_vehicle_id.
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        for table in ("log", "trips", "stats_per_day", "errors"):
+            columns = [row[1] for row in cur.execute(f'PRAGMA table_info({table});')]
+            if "vehicle_id" not in columns:
+                logging.info(f"adding vehicle_id column to {table}, existing rows belong to {default_vehicle_id}")
+                cur.execute(f'ALTER TABLE {table} ADD COLUMN vehicle_id TEXT;')
+                cur.execute(f'UPDATE {table} SET vehicle_id = ?;', (default_vehicle_id,))
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS api_usage (
+                        account TEXT,
+                        date TEXT,
+                        calls INTEGER,
+                        PRIMARY KEY (account, date)
+                    )''')
+        conn.commit()
+
     def get_last_update_timestamp(self) -> datetime.datetime:
 
         conn = self.create_connection()
         cur = conn.cursor()
 
-        sql = 'SELECT MAX(unix_last_vehicle_update_timestamp) FROM log;'
-        cur.execute(sql)
+        sql = f'SELECT MAX(unix_last_vehicle_update_timestamp) FROM log WHERE {self.get_log_vehicle_filter(cur)};'
+        cur.execute(sql, (self.vehicle_client.vehicle_id,))
         rows = cur.fetchone()
 
-        return datetime.datetime.fromtimestamp(rows[0])
+        # a vehicle that was just added to the fleet has no saved data yet
+        return datetime.datetime.fromtimestamp(rows[0] or 0)
 
     def get_last_update_odometer(self) -> float:
 
         conn = self.create_connection()
         cur = conn.cursor()
 
-        sql = 'SELECT MAX(odometer) FROM log;'
-        cur.execute(sql)
+        sql = f'SELECT MAX(odometer) FROM log WHERE {self.get_log_vehicle_filter(cur)};'
+        cur.execute(sql, (self.vehicle_client.vehicle_id,))
         rows = cur.fetchone()
 
-        return rows[0]
+        return rows[0] or 0
 
     def get_most_recent_saved_trip_timestamp(self):
         conn = self.create_connection()
@@ -53,8 +161,8 @@ class DatabaseClient:
         cur = conn.cursor()
 
         # # fetch the last known vehicule force refresh timestamp.
-        sql = 'SELECT MAX(unix_timestamp) FROM trips;'
-        cur.execute(sql)
+        sql = 'SELECT MAX(unix_timestamp) FROM trips WHERE vehicle_id = ?;'
+        cur.execute(sql, (self.vehicle_client.vehicle_id,))
         rows = cur.fetchone()
 
         try:
@@ -81,6 +189,7 @@ class DatabaseClient:
 
         sql = f'''
         INSERT INTO trips(
+                vehicle_id,
             	unix_timestamp,
             	date,
                 driving_time_minutes,
@@ -90,6 +199,7 @@ class DatabaseClient:
                 max_speed_kmh
         )
                     VALUES(
+                        '{self.vehicle_client.vehicle_id}',
                         {round(datetime.datetime.timestamp(timestamp))},
                         "{timestamp.strftime("%Y-%m-%d %H:%M")}",
                         {trip.drive_time},
@@ -127,6 +237,7 @@ class DatabaseClient:
                                      )
 
         sql = f'''INSERT INTO log(
+                    vehicle_id,
                     battery_percentage,
                     accessory_battery_percentage,
                     estimated_range_km,
@@ -146,6 +257,7 @@ class DatabaseClient:
                     raw_api_data
       )
                   VALUES(
+                      '{self.vehicle_client.vehicle_id}',
                       {self.vehicle_client.vehicle.ev_battery_percentage},
                       {self.vehicle_client.vehicle.car_battery_percentage},
                       {self.vehicle_client.vehicle.ev_driving_range},
@@ -168,13 +280,16 @@ class DatabaseClient:
         cur.execute(sql)
         conn.commit()
 
+        for listener in self.log_listeners:
+            listener()
+
     def save_daily_stats(self):
         conn = self.create_connection()
         cur = conn.cursor()
 
         # for each day, check if day already saved in database to prevent duplicates
-        sql = 'SELECT date FROM stats_per_day;'
-        cur.execute(sql)
+        sql = 'SELECT date FROM stats_per_day WHERE vehicle_id = ?;'
+        cur.execute(sql, (self.vehicle_client.vehicle_id,))
         rows = cur.fetchall()
 
         for day in self.vehicle_client.vehicle.daily_stats:
@@ -183,7 +298,8 @@ class DatabaseClient:
                 # delete saved day (we'll replace it with the most up-to-date data for this day)
                 logging.debug(f'deleting previously saved day: {day.date.strftime("%Y-%m-%d")}')
                 sql = f"""DELETE FROM stats_per_day
-                WHERE date = '{day.date.strftime("%Y-%m-%d")}'"""
+                WHERE date = '{day.date.strftime("%Y-%m-%d")}'
+                AND vehicle_id = '{self.vehicle_client.vehicle_id}'"""
                 cur.execute(sql)
 
             average_consumption = 0
@@ -194,6 +310,7 @@ class DatabaseClient:
                         100 / day.distance)
 
             sql = f''' INSERT INTO stats_per_day(
+                       vehicle_id,
                        date,
                        unix_timestamp,
                        total_consumed_kwh,
@@ -207,6 +324,7 @@ class DatabaseClient:
                        average_consumption_regen_deducted_kwh
              )
                          VALUES(
+                             '{self.vehicle_client.vehicle_id}',
                              '{day.date.strftime("%Y-%m-%d")}',
                              {round(datetime.datetime.timestamp(day.date))},
                              {round(day.total_consumed / 1000, 1)},
@@ -223,19 +341,619 @@ class DatabaseClient:
             cur.execute(sql)
             conn.commit()
 
+    def create_poll_model_tables(self):
+        """
+        Creates the poll scheduler tables, for databases created before they were added to the schema.
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS poll_model (
+                        vehicle_id TEXT,
+                        hour_of_week INTEGER,
+                        event_count REAL,
+                        PRIMARY KEY (vehicle_id, hour_of_week)
+                    )''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS poll_model_watermark (
+                        vehicle_id TEXT PRIMARY KEY,
+                        last_trip_unix_timestamp INTEGER,
+                        last_log_unix_timestamp INTEGER,
+                        last_charging INTEGER
+                    )''')
+        conn.commit()
+
+    def get_poll_model_counts(self) -> list:
+        """
+        Returns the number of state change events seen for each hour of the week (168 values)
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('SELECT hour_of_week, event_count FROM poll_model WHERE vehicle_id = ?;',
+                    (self.vehicle_client.vehicle_id,))
+        counts = [0.0] * 24 * 7
+        for hour_of_week, event_count in cur.fetchall():
+            counts[hour_of_week] = event_count
+
+        return counts
+
+    def get_poll_model_watermark(self) -> [tuple, None]:
+        """
+        Returns the last trip timestamp, last log timestamp and last charging state ingested by the poll model,
+        None if the poll model of the vehicle was never updated
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('''SELECT last_trip_unix_timestamp, last_log_unix_timestamp, last_charging
+                    FROM poll_model_watermark WHERE vehicle_id = ?;''', (self.vehicle_client.vehicle_id,))
+        row = cur.fetchone()
+
+        return row
+
+    def save_poll_model(self, counts: list, last_trip_ts: int, last_log_ts: int, last_charging: int):
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        vehicle_id = self.vehicle_client.vehicle_id
+        cur.executemany('INSERT OR REPLACE INTO poll_model(vehicle_id, hour_of_week, event_count) VALUES(?, ?, ?)',
+                        [(vehicle_id, hour_of_week, count) for hour_of_week, count in enumerate(counts)])
+        cur.execute('''INSERT OR REPLACE INTO poll_model_watermark(
+                        vehicle_id,
+                        last_trip_unix_timestamp,
+                        last_log_unix_timestamp,
+                        last_charging
+                    ) VALUES(?, ?, ?, ?)''', (vehicle_id, last_trip_ts, last_log_ts, last_charging))
+        conn.commit()
+
+    def get_trip_timestamps_since(self, unix_timestamp: int) -> list:
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('''SELECT unix_timestamp FROM trips
+                    WHERE vehicle_id = ? AND unix_timestamp > ?
+                    ORDER BY unix_timestamp;''', (self.vehicle_client.vehicle_id, unix_timestamp))
+
+        return [row[0] for row in cur.fetchall()]
+
+    def get_charging_states_since(self, unix_timestamp: int, include_archives: bool = False) -> list:
+        """
+        Returns (unix_last_vehicle_update_timestamp, charging) pairs saved after the given timestamp, oldest first
+        :param include_archives: also read the archived months (see get_history_table())
+        """
+        table = self.get_history_table(include_archives)
+        conn = self.create_connection(include_archives=table == "log_all")
+        cur = conn.cursor()
+
+        cur.execute(f'''SELECT unix_last_vehicle_update_timestamp, charging FROM {table}
+                    WHERE {self.get_log_vehicle_filter(cur, table)} AND unix_last_vehicle_update_timestamp > ?
+                    ORDER BY unix_last_vehicle_update_timestamp;''', (self.vehicle_client.vehicle_id, unix_timestamp))
+        rows = cur.fetchall()
+        conn.close()
+
+        return rows
+
+    def create_log_timestamp_index(self):
+        """
+        Creates the log timestamp index on v1 databases (see compact_db.py).
+        In v2 databases, log is a view over log_v2, which is already clustered on the timestamp.
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute("SELECT type FROM sqlite_master WHERE name = 'log';")
+        if cur.fetchone()[0] == 'table':
+            cur.execute('CREATE INDEX IF NOT EXISTS log_unix_timestamp ON log(unix_timestamp);')
+            conn.commit()
+
+    def get_last_log_rows(self, fields: list) -> list:
+        """
+        Returns the most recent log row of each vehicle as dicts
+        :param fields: columns to return, in addition to unix_timestamp and vehicle_id
+        """
+        conn = self.create_connection()
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+
+        # in v2 databases, grouped by the integer vehicle key of log_v2
+        key = "vehicle" if self.is_log_view(cur) else "vehicle_id"
+        cur.execute(f'''SELECT log.unix_timestamp, log.vehicle_id, {", ".join(f"log.{field}" for field in fields)}
+                    FROM log
+                    JOIN (SELECT {key}, MAX(unix_timestamp) AS unix_timestamp FROM log GROUP BY {key}) AS last
+                    ON log.{key} IS last.{key} AND log.unix_timestamp = last.unix_timestamp;''')
+
+        return [dict(row) for row in cur.fetchall()]
+
+    def get_log_rows_since(self, unix_timestamp: int, fields: list) -> list:
+        """
+        Returns the log rows saved after the given timestamp as dicts, oldest first.
+        (unix_timestamp, log_key) identifies a row: log_key is the rowid in v1 databases, which have no unique key, and
+        the vehicle key of the log_v2 primary key in v2 databases.
+        :param unix_timestamp: save timestamp (unix_timestamp column) of the last row already known
+        :param fields: columns to return, in addition to unix_timestamp, vehicle_id and log_key
+        """
+        conn = self.create_connection()
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+
+        cur.execute(f'''SELECT unix_timestamp, vehicle_id, {self.get_log_key(cur)} AS log_key, {", ".join(fields)}
+                    FROM log
+                    WHERE unix_timestamp > ?
+                    ORDER BY unix_timestamp, log_key;''', (unix_timestamp,))
+
+        return [dict(row) for row in cur.fetchall()]
+
+    def archive_old_months(self):
+        """
+        Moves log rows older than the hot months into monthly archive files, then vacuums the hot database.
+        The month of the most recent row is never archived, so that the hot log table is never empty.
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('SELECT MIN(unix_timestamp), MAX(unix_timestamp) FROM log;')
+        oldest_ts, newest_ts = cur.fetchone()
+        conn.close()
+
+        if oldest_ts is None:
+            return
+
+        newest_month = datetime.datetime.fromtimestamp(newest_ts).replace(day=1, hour=0, minute=0, second=0,
+                                                                           microsecond=0)
+        hot_start = min(newest_month,
+                        datetime.datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                        - relativedelta(months=self.HOT_MONTHS - 1))
+
+        month_start = datetime.datetime.fromtimestamp(oldest_ts).replace(day=1, hour=0, minute=0, second=0,
+                                                                          microsecond=0)
+        archived_months = 0
+        while month_start < hot_start:
+            month_end = month_start + relativedelta(months=1)
+            if self.archive_month(month_start, month_end):
+                archived_months += 1
+            month_start = month_end
+
+        if archived_months:
+            logging.info(f"archived {archived_months} months of log, vacuuming...")
+            conn = self.create_connection()
+            conn.execute('VACUUM;')
+            conn.close()
+
+    def archive_month(self, month_start: datetime.datetime, month_end: datetime.datetime) -> bool:
+        """
+        Moves the log rows of a month to its archive file.
+        If the month was already archived (late rows), the archive is reopened and the rows appended.
+        :return: True if rows were moved
+        """
+        start_ts = round(datetime.datetime.timestamp(month_start))
+        end_ts = round(datetime.datetime.timestamp(month_end))
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archive_path = os.path.join(self.archive_dir, f"log_{month_start.strftime('%Y_%m')}.db")
+        compressed_path = archive_path + ".gz"
+
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('SELECT COUNT(*) FROM log WHERE unix_timestamp >= ? AND unix_timestamp < ?;', (start_ts, end_ts))
+        if cur.fetchone()[0] == 0:
+            conn.close()
+            return False
+
+        # an uncompressed archive is left behind if a previous run stopped before compressing it
+        if os.path.exists(compressed_path) and not os.path.exists(archive_path):
+            with gzip.open(compressed_path, "rb") as source, open(archive_path, "wb") as destination:
+                shutil.copyfileobj(source, destination)
+
+        cur.execute('ATTACH DATABASE ? AS archive;', (archive_path,))
+        cur.execute('CREATE TABLE IF NOT EXISTS archive.log AS SELECT * FROM main.log WHERE 0;')
+        cur.execute('CREATE INDEX IF NOT EXISTS archive.log_unix_timestamp ON log(unix_timestamp);')
+
+        # the hot table may have gained columns since the archive was created
+        archive_columns = [row[1] for row in cur.execute('PRAGMA archive.table_info(log);')]
+        columns = [row[1] for row in cur.execute('PRAGMA main.table_info(log);')]
+        for column in columns:
+            if column not in archive_columns:
+                cur.execute(f'ALTER TABLE archive.log ADD COLUMN "{column}";')
+
+        column_list = ", ".join(f'"{column}"' for column in columns)
+        # both statements are committed in the same transaction: rows are never lost nor duplicated
+        cur.execute(f'''INSERT INTO archive.log({column_list})
+                    SELECT {column_list} FROM main.log
+                    WHERE unix_timestamp >= ? AND unix_timestamp < ?;''', (start_ts, end_ts))
+        cur.execute('DELETE FROM main.log WHERE unix_timestamp >= ? AND unix_timestamp < ?;', (start_ts, end_ts))
+        logging.info(f"archiving {cur.rowcount} log rows to {compressed_path}")
+        conn.commit()
+        cur.execute('DETACH DATABASE archive;')
+        conn.close()
+
+        with open(archive_path, "rb") as source, gzip.open(compressed_path + ".tmp", "wb") as destination:
+            shutil.copyfileobj(source, destination)
+        os.replace(compressed_path + ".tmp", compressed_path)
+        os.chmod(compressed_path, 0o444)
+        os.remove(archive_path)
+
+        return True
+
+    def get_archived_months(self) -> list:
+        """
+        Returns the archived months, oldest first, in the YYYY_MM format
+        """
+        months = set()
+        for path in glob.glob(os.path.join(self.archive_dir, "log_*.db*")):
+            match = re.fullmatch(r"log_(\d{4}_\d{2})\.db(\.gz)?", os.path.basename(path))
+            if match:
+                months.add(match.group(1))
+
+        return sorted(months)
+
+    def build_archive_copy(self) -> str:
+        """
+        Decompresses all the archived months into a single temporary database, so that any history length is
+        readable through one attached database (sqlite cannot attach more than 10).
+        Each copy is built in its own directory: the daemon and the HTTP server may build one at the same time.
+        Copies left behind by a previous process are deleted first.
+        :return: path of the copy
+        """
+        cache_dir = os.path.join(self.archive_dir, "cache")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            try:
+                if os.path.getmtime(path) < datetime.datetime.now().timestamp() - self.STALE_ARCHIVE_COPY_SECONDS:
+                    shutil.rmtree(path)
+            except OSError:
+                # deleted by another process in the meantime
+                pass
+
+        build_dir = tempfile.mkdtemp(prefix="log_archive_", dir=cache_dir)
+        copy_path = os.path.join(build_dir, "log.db")
+
+        conn = sqlite3.connect(copy_path)
+        cur = conn.cursor()
+        # columns of the hot log, which archives created before a schema change may lack
+        cur.execute('ATTACH DATABASE ? AS hot;', (self.db_path,))
+        columns = [row[1] for row in cur.execute('PRAGMA hot.table_info(log);')]
+        cur.execute('CREATE TABLE main.log AS SELECT * FROM hot.log WHERE 0;')
+        cur.execute('DETACH DATABASE hot;')
+
+        for month in self.get_archived_months():
+            archive_path = os.path.join(self.archive_dir, f"log_{month}.db")
+            month_path = archive_path
+            if os.path.exists(archive_path + ".gz"):
+                month_path = os.path.join(build_dir, f"log_{month}.db")
+                with gzip.open(archive_path + ".gz", "rb") as source, open(month_path, "wb") as destination:
+                    shutil.copyfileobj(source, destination)
+
+            cur.execute('ATTACH DATABASE ? AS month;', (month_path,))
+            month_columns = [row[1] for row in cur.execute('PRAGMA month.table_info(log);')]
+            column_list = ", ".join(f'"{column}"' for column in columns)
+            select_list = ", ".join(f'"{column}"' if column in month_columns else "NULL" for column in columns)
+            cur.execute(f'INSERT INTO main.log({column_list}) SELECT {select_list} FROM month.log;')
+            conn.commit()
+            cur.execute('DETACH DATABASE month;')
+
+            if month_path != archive_path:
+                os.remove(month_path)
+
+        cur.execute('CREATE INDEX log_unix_timestamp ON log(unix_timestamp);')
+        conn.commit()
+        conn.close()
+
+        return copy_path
+
+    def attach_archives(self, conn: Connection):
+        """
+        Attaches a read-only copy of the archived months and creates the temporary log_all view over it and the hot
+        log table.
+        The copy is deleted right after being attached: the connection keeps reading it, and its disk space is
+        released when the connection is closed.
+        """
+        if not self.get_archived_months():
+            conn.execute('CREATE TEMP VIEW log_all AS SELECT * FROM main.log;')
+            return
+
+        copy_path = self.build_archive_copy()
+
+        cur = conn.cursor()
+        cur.execute('ATTACH DATABASE ? AS archive;', (f"file:{urllib.parse.quote(copy_path)}?mode=ro&immutable=1",))
+        columns = ", ".join(f'"{row[1]}"' for row in cur.execute('PRAGMA main.table_info(log);'))
+        cur.execute(f'''CREATE TEMP VIEW log_all AS
+                    SELECT {columns} FROM main.log
+                    UNION ALL
+                    SELECT {columns} FROM archive.log;''')
+
+        # the file cannot be deleted while open on Windows: a later copy deletes it
+        shutil.rmtree(os.path.dirname(copy_path), ignore_errors=True)
+
+    def get_history_table(self, include_archives: bool) -> str:
+        """
+        Returns the table to read log rows from: log_all if the archived months must be read and there are some,
+        log otherwise.
+        Reading log_all decompresses every archived month: only the first update of a model does it, the following
+        ones only read rows that are still in the hot log. Models save their watermark even when they found no row,
+        the watermark row recording that the archived history was read.
+        """
+        if include_archives and self.get_archived_months():
+            return "log_all"
+
+        return "log"
+
+    def create_consumption_tables(self):
+        """
+        Creates the consumption analytics tables, for databases created before they were added to the schema.
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS consumption_per_day (
+                        vehicle_id TEXT,
+                        date TEXT,
+                        unix_timestamp INTEGER,
+                        efficiency_kwh_100km REAL,
+                        efficiency_regen_deducted_kwh_100km REAL,
+                        climate_share_percent REAL,
+                        drivetrain_share_percent REAL,
+                        rolling_7d_efficiency_kwh_100km REAL,
+                        rolling_30d_efficiency_kwh_100km REAL,
+                        PRIMARY KEY (vehicle_id, date)
+                    )''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS consumption_per_month_of_year (
+                        vehicle_id TEXT,
+                        month INTEGER,
+                        distance_km REAL,
+                        efficiency_kwh_100km REAL,
+                        PRIMARY KEY (vehicle_id, month)
+                    )''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS consumption_per_speed (
+                        vehicle_id TEXT,
+                        speed_bucket_kmh INTEGER,
+                        trips INTEGER,
+                        distance_km REAL,
+                        driving_time_minutes REAL,
+                        estimated_kwh REAL,
+                        efficiency_kwh_100km REAL,
+                        PRIMARY KEY (vehicle_id, speed_bucket_kmh)
+                    )''')
+        conn.commit()
+
+    def get_daily_stats(self, columns: list) -> list:
+        """
+        Returns the daily stats of the vehicle, oldest first
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute(f'SELECT {", ".join(columns)} FROM stats_per_day WHERE vehicle_id = ? ORDER BY date;',
+                    (self.vehicle_client.vehicle_id,))
+
+        return cur.fetchall()
+
+    def get_trips(self, columns: list) -> list:
+        """
+        Returns the trips of the vehicle, oldest first
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute(f'SELECT {", ".join(columns)} FROM trips WHERE vehicle_id = ? ORDER BY unix_timestamp;',
+                    (self.vehicle_client.vehicle_id,))
+
+        return cur.fetchall()
+
+    def get_last_consumption_date(self) -> [str, None]:
+        """
+        Returns the most recent date materialized in consumption_per_day for the vehicle, None if there is none
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('SELECT MAX(date) FROM consumption_per_day WHERE vehicle_id = ?;', (self.vehicle_client.vehicle_id,))
+
+        return cur.fetchone()[0]
+
+    def save_consumption_rows(self, table: str, key_column: str, columns: list, keys, values: list,
+                              since_key=None) -> int:
+        """
+        Saves materialized analytics rows of the vehicle. Only new or changed rows are written,
+        rows whose key is not in keys anymore are deleted.
+        :param table: materialized table
+        :param key_column: column identifying a row, in addition to vehicle_id
+        :param columns: value columns
+        :param keys: key of each row
+        :param values: one sequence per value column, NaN for NULL
+        :param since_key: only the saved rows from this key on are replaced, the ones before are kept
+        :return: number of rows written
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        vehicle_id = self.vehicle_client.vehicle_id
+
+        if since_key is None:
+            cur.execute(f'SELECT {key_column}, {", ".join(columns)} FROM {table} WHERE vehicle_id = ?;',
+                        (vehicle_id,))
+        else:
+            cur.execute(f'SELECT {key_column}, {", ".join(columns)} FROM {table} '
+                        f'WHERE vehicle_id = ? AND {key_column} >= ?;', (vehicle_id, since_key))
+        saved_rows = {row[0]: row[1:] for row in cur.fetchall()}
+
+        rows = []
+        for i, key in enumerate(keys):
+            key = key.item() if hasattr(key, "item") else key
+            # NaN != NaN: store NULL instead. values are rounded so that float noise does not count as a change
+            row = tuple(None if value[i] != value[i] else round(float(value[i]), 3) for value in values)
+            if saved_rows.pop(key, None) != row:
+                rows.append((vehicle_id, key) + row)
+
+        placeholders = ", ".join("?" * (len(columns) + 2))
+        cur.executemany(f'INSERT OR REPLACE INTO {table}(vehicle_id, {key_column}, {", ".join(columns)}) '
+                        f'VALUES({placeholders});', rows)
+        cur.executemany(f'DELETE FROM {table} WHERE vehicle_id = ? AND {key_column} = ?;',
+                        [(vehicle_id, key) for key in saved_rows])
+        conn.commit()
+
+        return len(rows)
+
+    def get_last_vehicle_log_row(self, fields: list) -> [dict, None]:
+        """
+        Returns the most recent log row of the vehicle as a dict, None if there is none
+        """
+        conn = self.create_connection()
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+
+        cur.execute(f'''SELECT unix_timestamp, {", ".join(fields)} FROM log
+                    WHERE {self.get_log_vehicle_filter(cur)}
+                    ORDER BY unix_timestamp DESC LIMIT 1;''', (self.vehicle_client.vehicle_id,))
+        row = cur.fetchone()
+
+        return dict(row) if row is not None else None
+
+    def create_prediction_tables(self):
+        """
+        Creates the prediction model tables, for databases created before they were added to the schema.
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS prediction_models (
+                        vehicle_id TEXT,
+                        model TEXT,
+                        samples INTEGER,
+                        xtx TEXT,
+                        xty TEXT,
+                        PRIMARY KEY (vehicle_id, model)
+                    )''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS prediction_watermark (
+                        vehicle_id TEXT PRIMARY KEY,
+                        unix_last_vehicle_update_timestamp INTEGER,
+                        battery_percentage INTEGER,
+                        charging INTEGER,
+                        odometer INTEGER
+                    )''')
+        conn.commit()
+
+    def begin_prediction_update(self) -> Connection:
+        """
+        Returns a connection holding the database write lock, to read the prediction models and save them back
+        atomically: both the daemon and the HTTP server update them.
+        The transaction is committed by save_prediction_models(), or rolled back when the connection is closed.
+        """
+        conn = self.create_connection()
+        conn.execute('BEGIN IMMEDIATE;')
+
+        return conn
+
+    def get_prediction_model(self, model: str, conn: Connection = None) -> tuple:
+        """
+        Returns the accumulated normal equations of a prediction model: (samples, X'WX, X'Wy)
+        X'WX and X'Wy are None if the model has no samples yet
+        :param conn: connection of the current prediction update, see begin_prediction_update()
+        """
+        conn = conn or self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('SELECT samples, xtx, xty FROM prediction_models WHERE vehicle_id = ? AND model = ?;',
+                    (self.vehicle_client.vehicle_id, model))
+        row = cur.fetchone()
+
+        if row is None:
+            return 0, None, None
+
+        return row[0], json.loads(row[1]), json.loads(row[2])
+
+    def get_prediction_watermark(self, conn: Connection = None) -> [tuple, None]:
+        """
+        Returns the last log row added to the prediction models:
+        (unix_last_vehicle_update_timestamp, battery_percentage, charging, odometer)
+        None if the models of the vehicle were never updated. Its values are NULL if no row was added yet
+        :param conn: connection of the current prediction update, see begin_prediction_update()
+        """
+        conn = conn or self.create_connection()
+        cur = conn.cursor()
+
+        cur.execute('''SELECT unix_last_vehicle_update_timestamp, battery_percentage, charging, odometer
+                    FROM prediction_watermark WHERE vehicle_id = ?;''', (self.vehicle_client.vehicle_id,))
+
+        return cur.fetchone()
+
+    def get_prediction_log_rows_since(self, unix_timestamp: int, include_archives: bool = False) -> list:
+        """
+        Returns (unix_last_vehicle_update_timestamp, battery_percentage, charging, odometer) rows of the vehicle
+        updated after the given timestamp, oldest first
+        :param include_archives: also read the archived months (see get_history_table())
+        """
+        table = self.get_history_table(include_archives)
+        conn = self.create_connection(include_archives=table == "log_all")
+        cur = conn.cursor()
+
+        cur.execute(f'''SELECT unix_last_vehicle_update_timestamp, battery_percentage, charging, odometer FROM {table}
+                    WHERE {self.get_log_vehicle_filter(cur, table)} AND unix_last_vehicle_update_timestamp > ?
+                    ORDER BY unix_last_vehicle_update_timestamp;''', (self.vehicle_client.vehicle_id, unix_timestamp))
+        rows = cur.fetchall()
+        conn.close()
+
+        return rows
+
+    def save_prediction_models(self, models: dict, last_row: tuple, conn: Connection = None):
+        """
+        :param models: model -> (samples, X'WX, X'Wy)
+        :param last_row: last log row added to the models, see get_prediction_watermark(). None if there is none
+        :param conn: connection of the current prediction update, see begin_prediction_update()
+        """
+        conn = conn or self.create_connection()
+        cur = conn.cursor()
+
+        vehicle_id = self.vehicle_client.vehicle_id
+        cur.executemany('INSERT OR REPLACE INTO prediction_models(vehicle_id, model, samples, xtx, xty) '
+                        'VALUES(?, ?, ?, ?, ?);',
+                        [(vehicle_id, model, samples, json.dumps(xtx), json.dumps(xty))
+                         for model, (samples, xtx, xty) in models.items()])
+        cur.execute('''INSERT OR REPLACE INTO prediction_watermark(
+                        vehicle_id,
+                        unix_last_vehicle_update_timestamp,
+                        battery_percentage,
+                        charging,
+                        odometer
+                    ) VALUES(?, ?, ?, ?, ?)''', (vehicle_id,) + tuple(last_row or (None, None, None, None)))
+        conn.commit()
+
+    def count_api_call(self, account: str, daily_budget: int) -> bool:
+        """
+        Counts an API call for the given account, unless it would exceed its daily budget.
+        The check and the count are a single statement: the daemon and the HTTP server share the budget.
+        :return: True if the call was counted, False if the budget is used up
+        """
+        conn = self.create_connection()
+        cur = conn.cursor()
+
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        cur.execute('''INSERT INTO api_usage(account, date, calls) SELECT ?, ?, 1 WHERE ? > 0
+                    ON CONFLICT(account, date) DO UPDATE SET calls = calls + 1 WHERE calls < ?;''',
+                    (account, today, daily_budget, daily_budget))
+        counted = cur.rowcount == 1
+        conn.commit()
+        conn.close()
+
+        return counted
+
     def log_error(self, exception: Exception):
         conn = self.create_connection()
         cur = conn.cursor()
 
         cur.execute(''' INSERT INTO errors(
+                   vehicle_id,
                    timestamp,
                    unix_timestamp,
                    exc_type,
                    exc_args
          )
-                     VALUES(?, ?, ?, ?)
+                     VALUES(?, ?, ?, ?, ?)
                      ''',
                     (
+                        self.vehicle_client.vehicle_id,
                         datetime.datetime.now(),
                         round(datetime.datetime.timestamp(datetime.datetime.now())),
                         type(exception).__name__,
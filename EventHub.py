@@ -0,0 +1,214 @@
+import json
+import logging
+import queue
+import threading
+
+import DatabaseClient
+
+
+class EventHub:
+    """
+    Server-sent events broadcast hub
+    Role:
+    - watch the log table for new rows, whoever saved them (the daemon in its own process, or an HTTP command job)
+    - push a compact delta of the changed status fields to every subscriber
+
+    Each event carries the vehicle_id, deltas are computed per vehicle.
+    Event IDs are log unix timestamps, so a client reconnecting with a Last-Event-ID header gets the rows it missed
+    replayed straight from the database. Watching the database never causes an upstream API call.
+
+    A row is committed up to the busy timeout of the database after its save timestamp, when its INSERT waits for the
+    lock. The rows saved in the REREAD_SECONDS before the last event ID are read again, and the rows already published
+    are skipped by their own key (see DatabaseClient.get_log_rows_since): in v1 databases, two rows of a vehicle saved in
+    the same second are both published. In v2 databases, the second one replaces the first under the same key and is
+    not published. A row committed late is published when it is found, so event IDs can go backwards.
+    """
+
+    # status fields pushed to subscribers. raw_api_data is deliberately left out.
+    FIELDS = ["battery_percentage",
+              "accessory_battery_percentage",
+              "estimated_range_km",
+              "unix_last_vehicle_update_timestamp",
+              "latitude",
+              "longitude",
+              "odometer",
+              "charging",
+              "engine_is_running",
+              "rough_charging_power_estimate_kw",
+              "ac_charge_limit_percent",
+              "dc_charge_limit_percent",
+              "target_climate_temperature"]
+
+    def __init__(self, db_client: DatabaseClient):
+        self.db_client = db_client
+
+        # the daemon writes from another process, so we also check the database periodically.
+        # rows saved by this process wake the watcher immediately through notify().
+        self.POLL_INTERVAL = 5
+        self.HEARTBEAT_INTERVAL = 15
+
+        # events buffered per subscriber. a subscriber that falls further behind is disconnected,
+        # it can resume from its last event ID.
+        self.SUBSCRIBER_QUEUE_SIZE = 100
+
+        # rows are committed up to the busy timeout after their save timestamp. doubled for the time spent before it.
+        self.REREAD_SECONDS = 2 * db_client.BUSY_TIMEOUT
+
+        self.subscribers = {}  # subscriber queue -> vehicle_id it is restricted to, or None for all vehicles
+        self.lock = threading.Lock()
+        self.wake_up = threading.Event()
+        self.last_event_id = 0
+        self.published_keys = set()  # keys of the rows published in the last REREAD_SECONDS
+        self.last_states = {}  # vehicle_id -> last known state
+        self.thread = None
+
+    def start(self):
+        self.db_client.create_log_timestamp_index()
+
+        for row in self.db_client.get_last_log_rows(self.FIELDS):
+            self.last_event_id = max(self.last_event_id, row["unix_timestamp"])
+            self.last_states[row["vehicle_id"]] = self.get_state(row)
+
+        self.published_keys = {self.get_row_key(row) for row in self.get_reread_rows(self.last_event_id)}
+
+        self.thread = threading.Thread(target=self.watch, name="event-hub", daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        """
+        Called when a log row has been saved in this process
+        """
+        self.wake_up.set()
+
+    def watch(self):
+        while True:
+            self.wake_up.wait(self.POLL_INTERVAL)
+            self.wake_up.clear()
+
+            try:
+                rows = self.get_reread_rows(self.last_event_id)
+            except Exception as e:
+                logging.exception(e)
+                continue
+
+            for row in rows:
+                key = self.get_row_key(row)
+                if key in self.published_keys:
+                    continue
+
+                self.published_keys.add(key)
+                self.last_event_id = max(self.last_event_id, row["unix_timestamp"])
+
+                state = self.get_state(row)
+                delta = self.get_delta(self.last_states.get(row["vehicle_id"], {}), state)
+                self.last_states[row["vehicle_id"]] = state
+                self.publish(row["vehicle_id"], self.format_event(key, row["vehicle_id"], delta))
+
+            # older rows are not read again
+            self.published_keys = {key for key in self.published_keys
+                                   if key[0] >= self.last_event_id - self.REREAD_SECONDS}
+
+    def get_reread_rows(self, last_event_id: int) -> list:
+        """
+        Returns the rows saved since REREAD_SECONDS before last_event_id: see the class docstring
+        """
+        return self.db_client.get_log_rows_since(last_event_id - self.REREAD_SECONDS - 1, self.FIELDS)
+
+    def publish(self, vehicle_id: str, event: tuple):
+        with self.lock:
+            subscribers = [subscriber for subscriber, vehicle_filter in self.subscribers.items()
+                           if vehicle_filter is None or vehicle_filter == vehicle_id]
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                logging.warning("SSE subscriber is too slow, disconnecting it")
+                self.unsubscribe(subscriber)
+
+    def subscribe(self, vehicle_id: [str, None] = None) -> queue.Queue:
+        subscriber = queue.Queue(maxsize=self.SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers[subscriber] = vehicle_id
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self.lock:
+            self.subscribers.pop(subscriber, None)
+
+    def stream(self, last_event_id: [int, None] = None, vehicle_id: [str, None] = None):
+        """
+        Generator yielding the SSE stream of a subscriber
+        :param last_event_id: ID of the last event received by the client, if it is resuming
+        :param vehicle_id: only stream the events of this vehicle. None: all vehicles
+        """
+        # subscribe before replaying so that no event is lost in between. duplicates are skipped by row key.
+        subscriber = self.subscribe(vehicle_id)
+        replayed_keys = set()
+
+        try:
+            yield f"retry: {self.POLL_INTERVAL * 1000}\n\n"
+
+            if last_event_id:
+                for key, _, data in self.get_replay(last_event_id, vehicle_id):
+                    replayed_keys.add(key)
+                    yield data
+
+            while True:
+                try:
+                    key, _, data = subscriber.get(timeout=self.HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    with self.lock:
+                        if subscriber not in self.subscribers:
+                            return
+                    yield ": heartbeat\n\n"
+                    continue
+
+                # each row is published once, it can only have been replayed already
+                if key in replayed_keys:
+                    continue
+
+                yield data
+        finally:
+            self.unsubscribe(subscriber)
+
+    def get_replay(self, last_event_id: int, vehicle_id: [str, None] = None) -> list:
+        """
+        Returns the events saved since REREAD_SECONDS before last_event_id.
+        Events saved shortly before the last received event are sent again: some may have been committed after the
+        client received it. The first event of each vehicle carries its full state, so receiving one twice is harmless.
+        """
+        rows = self.get_reread_rows(last_event_id)
+
+        states = {}
+        events = []
+        for row in rows:
+            if vehicle_id is not None and row["vehicle_id"] != vehicle_id:
+                continue
+
+            new_state = self.get_state(row)
+            delta = self.get_delta(states.get(row["vehicle_id"], {}), new_state)
+            events.append(self.format_event(self.get_row_key(row), row["vehicle_id"], delta))
+            states[row["vehicle_id"]] = new_state
+
+        return events
+
+    @staticmethod
+    def get_row_key(row: dict) -> tuple:
+        return row["unix_timestamp"], row["log_key"]
+
+    def get_state(self, row: dict) -> dict:
+        return {field: row[field] for field in self.FIELDS}
+
+    @staticmethod
+    def get_delta(previous_state: dict, state: dict) -> dict:
+        return {field: value for field, value in state.items()
+                if field not in previous_state or previous_state[field] != value}
+
+    @staticmethod
+    def format_event(key: tuple, vehicle_id: str, delta: dict) -> tuple:
+        """
+        :param key: row key, see get_row_key(). The event ID is the save timestamp of the row.
+        """
+        data = json.dumps({"vehicle_id": vehicle_id, **delta})
+        return key, vehicle_id, f"id: {key[0]}\nevent: status\ndata: {data}\n\n"
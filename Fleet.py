@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from Account import Account
+from VehicleClient import VehicleClient
+
+
+class Fleet:
+    """
+    Fleet of vehicles, possibly spread across several accounts, brands and regions
+    Role:
+    - load the fleet configuration (KIA_FLEET_CONFIG), or the single vehicle defined in the .env file
+    - create one VehicleClient per vehicle. vehicles of the same account share its login and API budget
+    - refresh all vehicles concurrently with a bounded pool of workers
+
+    Configuration file example (see fleet.json.default):
+    {
+        "max_workers": 4,
+        "accounts": [
+            {"name": "kia", "username": "...", "password": "...", "region": 1, "brand": 1, "daily_api_budget": 200,
+             "vehicles": [{"id": "<vehicle UUID>", "name": "niro"}]}
+        ]
+    }
+    """
+
+    def __init__(self, config_path: str = None):
+        """
+        :param config_path: path to the fleet configuration. defaults to KIA_FLEET_CONFIG
+        """
+
+        # load env vars from .env file
+        load_dotenv()
+
+        self.vehicle_clients: dict = {}  # vehicle UUID -> VehicleClient
+        self.vehicle_names: dict = {}  # vehicle UUID -> name used in logs and HTTP requests
+        self.max_workers: int = 1
+
+        config_path = config_path or os.environ.get("KIA_FLEET_CONFIG")
+
+        if not config_path:
+            # single vehicle mode
+            vehicle_client = VehicleClient()
+            self.vehicle_clients[vehicle_client.vehicle_id] = vehicle_client
+            self.vehicle_names[vehicle_client.vehicle_id] = vehicle_client.vehicle_id
+            return
+
+        with open(config_path) as config_file:
+            config = json.load(config_file)
+
+        self.max_workers = config.get("max_workers", 4)
+
+        for account_config in config["accounts"]:
+            account = Account(name=account_config["name"],
+                              username=account_config["username"],
+                              password=account_config["password"],
+                              pin=account_config.get("pin", ""),
+                              region=account_config.get("region", 1),
+                              brand=account_config.get("brand", 1),
+                              daily_api_budget=account_config.get("daily_api_budget", 200))
+
+            for vehicle_config in account_config["vehicles"]:
+                vehicle_client = VehicleClient(account=account, vehicle_id=vehicle_config["id"])
+                self.vehicle_clients[vehicle_client.vehicle_id] = vehicle_client
+                self.vehicle_names[vehicle_client.vehicle_id] = vehicle_config.get("name", vehicle_config["id"])
+
+    def get_accounts(self) -> list:
+        accounts = []
+        for vehicle_client in self.vehicle_clients.values():
+            if vehicle_client.account not in accounts:
+                accounts.append(vehicle_client.account)
+
+        return accounts
+
+    def get_vehicle_client(self, vehicle: [str, None] = None) -> [VehicleClient, None]:
+        """
+        Finds a vehicle client by vehicle UUID or name.
+        :param vehicle: UUID or name. may be omitted when the fleet has a single vehicle
+        :return: the vehicle client, None if not found
+        """
+        if not vehicle:
+            if len(self.vehicle_clients) == 1:
+                return next(iter(self.vehicle_clients.values()))
+            return None
+
+        if vehicle in self.vehicle_clients:
+            return self.vehicle_clients[vehicle]
+
+        for vehicle_id, name in self.vehicle_names.items():
+            if name == vehicle:
+                return self.vehicle_clients[vehicle_id]
+
+        return None
+
+    def set_logger(self, logger: logging.Logger):
+        for vehicle_id, vehicle_client in self.vehicle_clients.items():
+            if len(self.vehicle_clients) == 1:
+                vehicle_client.logger = logger
+            else:
+                vehicle_client.logger = logger.getChild(self.vehicle_names[vehicle_id])
+
+    def refresh_all(self):
+        """
+        Refreshes every vehicle, at most max_workers at a time.
+        An exception raised for a vehicle does not prevent the others from being refreshed.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(vehicle_client.refresh): vehicle_client
+                       for vehicle_client in self.vehicle_clients.values()}
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    futures[future].logger.exception("refresh failed:", exc_info=e)
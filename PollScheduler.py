@@ -0,0 +1,145 @@
+import datetime
+import logging
+
+import DatabaseClient
+
+HOURS_PER_WEEK = 24 * 7
+
+
+class PollScheduler:
+    """
+    Predictive poll scheduler
+    Role:
+    - learn, per hour of the week, how likely the car is to change state (start a trip or a charging session)
+    - spread the daily force refresh budget over the coming hours according to that probability
+
+    The model is a 168-bucket histogram (one bucket per hour of the week) of state change events:
+    - trip starts, from the trips table
+    - charging starts, from the log table (charging going from 0 to 1)
+    It is persisted in the database and updated incrementally: only events newer than the last processed
+    timestamps are read on each run.
+    """
+
+    def __init__(self, db_client: DatabaseClient):
+        self.db_client = db_client
+
+        # pseudo-count added to every bucket, so that hours without history still get a share of the budget.
+        # with no history at all, the budget is spread evenly across the day.
+        self.SMOOTHING_PSEUDO_COUNT = 1.0
+
+        # weight given to each neighbouring hour when smoothing the histogram.
+        # trips starting at 7:55 and 8:05 should both make 7h and 8h likely.
+        self.NEIGHBOUR_WEIGHT = 0.25
+
+        self.event_counts: [list, None] = None
+
+    def load(self):
+        """
+        Loads the persisted model from the database, then ingests events that happened since the last update.
+        """
+        self.event_counts = self.db_client.get_poll_model_counts()
+        self.update()
+
+    def update(self):
+        """
+        Incrementally adds trip and charging start events that are newer than the last processed ones.
+        """
+        if self.event_counts is None:
+            self.load()
+            return
+
+        watermark = self.db_client.get_poll_model_watermark()
+        # the archived months are only read by the first update, see DatabaseClient.get_history_table()
+        first_update = watermark is None
+        last_trip_ts, last_log_ts, last_charging = watermark or (0, 0, 0)
+
+        new_events = 0
+
+        trip_timestamps = self.db_client.get_trip_timestamps_since(last_trip_ts)
+        for unix_timestamp in trip_timestamps:
+            self.event_counts[self.get_hour_of_week(unix_timestamp)] += 1
+            new_events += 1
+        if trip_timestamps:
+            last_trip_ts = trip_timestamps[-1]
+
+        # charging starts are transitions, so we carry the last known charging state over from the previous run
+        charging_rows = self.db_client.get_charging_states_since(last_log_ts, include_archives=first_update)
+        for unix_timestamp, charging in charging_rows:
+            if charging and not last_charging:
+                self.event_counts[self.get_hour_of_week(unix_timestamp)] += 1
+                new_events += 1
+            last_charging = charging
+        if charging_rows:
+            last_log_ts = charging_rows[-1][0]
+
+        if trip_timestamps or charging_rows or first_update:
+            logging.debug(f"poll scheduler: ingested {new_events} new state change events")
+            self.db_client.save_poll_model(self.event_counts, last_trip_ts, last_log_ts, last_charging)
+
+    @staticmethod
+    def get_hour_of_week(unix_timestamp: int) -> int:
+        """
+        Returns the hour of the week (0 = monday 0h, 167 = sunday 23h) in local time.
+        Trips are saved with local timestamps, so local time is what matches driving habits.
+        """
+        date = datetime.datetime.fromtimestamp(unix_timestamp)
+        return date.weekday() * 24 + date.hour
+
+    def get_probabilities(self) -> list:
+        """
+        Returns the smoothed probability of a state change for each hour of the week.
+        """
+        if self.event_counts is None:
+            self.load()
+
+        smoothed = []
+        for hour in range(HOURS_PER_WEEK):
+            previous_hour = self.event_counts[(hour - 1) % HOURS_PER_WEEK]
+            next_hour = self.event_counts[(hour + 1) % HOURS_PER_WEEK]
+            smoothed.append((1 - 2 * self.NEIGHBOUR_WEIGHT) * self.event_counts[hour]
+                            + self.NEIGHBOUR_WEIGHT * (previous_hour + next_hour)
+                            + self.SMOOTHING_PSEUDO_COUNT)
+
+        total = sum(smoothed)
+        return [value / total for value in smoothed]
+
+    def get_interval(self, daily_budget: float, min_interval: int, max_interval: int,
+                     now: datetime.datetime = None) -> int:
+        """
+        Returns the force refresh interval to use right now.
+        The daily budget is split over the next 24 hours proportionally to the probability of each hour, each hour
+        getting between one refresh per max_interval and one per min_interval. The share of the hours held at a bound
+        is spread over the others, so that the 24 hours still add up to the daily budget.
+        The interval is the inverse of the share allocated to the current hour.
+        :param daily_budget: number of force refreshes we can afford per day while the car is off
+        :param min_interval: lower bound for the interval, in seconds
+        :param max_interval: upper bound for the interval, in seconds
+        :param now: current time, defaults to now
+        :return: interval in seconds
+        """
+        now = now or datetime.datetime.now()
+        probabilities = self.get_probabilities()
+
+        current_hour = now.weekday() * 24 + now.hour
+        next_24_hours = [probabilities[(current_hour + i) % HOURS_PER_WEEK] for i in range(24)]
+
+        # refreshes per hour
+        min_rate = 3600 / max_interval
+        max_rate = 3600 / min_interval
+
+        def get_rates(scale: float) -> list:
+            return [max(min_rate, min(max_rate, scale * probability)) for probability in next_24_hours]
+
+        # the rates add up to the budget for a single scale of the probabilities: bisect it.
+        # a budget outside of what the bounds allow leaves every hour at a bound
+        low_scale, high_scale = 0, max_rate / min(next_24_hours)
+        for i in range(50):
+            scale = (low_scale + high_scale) / 2
+            if sum(get_rates(scale)) < daily_budget:
+                low_scale = scale
+            else:
+                high_scale = scale
+
+        refreshes_this_hour = get_rates(high_scale)[0]
+
+        return round(3600 / refreshes_this_hour)
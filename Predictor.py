@@ -0,0 +1,208 @@
+import datetime
+import logging
+
+import numpy as np
+
+import DatabaseClient
+
+
+class Predictor:
+    """
+    Charge time and range predictions, learnt from the vehicle's own log
+    Role:
+    - extract charging and driving samples from consecutive log rows
+    - fit, by weighted least squares, a charging curve (charge rate against state of charge) for AC and DC charging
+      and a range model (km per battery percent, with a yearly seasonal component)
+    - answer predictions from the fitted parameters, kept in memory and refitted from the database at each update
+
+    Fits are incremental: the normal equations (X'WX and X'Wy) are accumulated in the database, so new log rows
+    are added to them without reading the history again, and solving them is a 3x3 linear system.
+    """
+
+    MODELS = ("charge_ac", "charge_dc", "range")
+
+    def __init__(self, db_client: DatabaseClient):
+        self.db_client = db_client
+
+        # charge rates above this are DC charging. the onboard AC charger (11 kW at most) cannot charge
+        # a 64 kWh battery faster than ~17%/h
+        self.DC_MIN_RATE_PERCENT_PER_HOUR = 25
+
+        # samples further apart are ignored: too much may have happened in between
+        self.CHARGE_MAX_SAMPLE_GAP_HOURS = 2
+        self.DRIVE_MAX_SAMPLE_GAP_HOURS = 24
+
+        # minimum number of samples before a model answers predictions
+        self.MIN_SAMPLES = 5
+
+        # ridge regularization, keeps the normal equations solvable with few or collinear samples
+        self.RIDGE = 1e-6
+
+        # lowest charge rate used when integrating the charging curve, so that the predicted time stays finite
+        self.MIN_RATE_PERCENT_PER_HOUR = 1
+
+        self.statistics: [dict, None] = None  # model -> (samples, X'WX, X'Wy)
+        self.parameters: dict = {}  # model -> fitted coefficients, None if not enough samples
+
+    def load(self):
+        self.read_statistics()
+        self.fit()
+
+    def read_statistics(self, conn=None):
+        """
+        :param conn: connection of the current prediction update, see DatabaseClient.begin_prediction_update()
+        """
+        self.statistics = {}
+        for model in self.MODELS:
+            samples, xtx, xty = self.db_client.get_prediction_model(model, conn)
+            self.statistics[model] = (samples, np.array(xtx or np.zeros((3, 3))), np.array(xty or np.zeros(3)))
+
+    def update(self):
+        """
+        Adds the log rows saved since the last update to the models, then refits them.
+        The daemon and the HTTP server both update the models: the saved models and watermark are read again, and
+        saved back, in a single write transaction, so that no log row is counted twice and no update is lost.
+        """
+        if self.statistics is None:
+            self.load()
+
+        # the log is read before taking the write lock, since the watermark of that time: it only moves forward
+        last_row = self.db_client.get_prediction_watermark()
+        # the archived months are only read by the first update, see DatabaseClient.get_history_table()
+        first_update = last_row is None
+        since = last_row[0] if last_row and last_row[0] is not None else 0
+        rows = self.db_client.get_prediction_log_rows_since(since, include_archives=first_update)
+        if not rows and not first_update:
+            # the models may still have been updated by another process
+            self.read_statistics()
+            self.fit()
+            return
+
+        conn = self.db_client.begin_prediction_update()
+        try:
+            self.read_statistics(conn)
+
+            # rows added by another process in the meantime are left out
+            last_row = self.db_client.get_prediction_watermark(conn)
+            if last_row and last_row[0] is not None:
+                rows = [row for row in rows if row[0] > last_row[0]]
+                # the last row of the previous update is the start of the first sample
+                samples_rows = [last_row] + rows
+            else:
+                samples_rows = rows
+
+            if rows:
+                self.add_samples(samples_rows)
+
+            # also saved when the first update found no row
+            if rows or last_row is None:
+                self.db_client.save_prediction_models({model: (samples, xtx.tolist(), xty.tolist())
+                                                       for model, (samples, xtx, xty) in self.statistics.items()},
+                                                      rows[-1] if rows else None, conn)
+        finally:
+            conn.close()
+
+        self.fit()
+
+    def add_samples(self, rows: list):
+        """
+        Accumulates the charging and driving samples of consecutive log rows
+        """
+        # columns: vehicle update timestamp, battery percentage, charging, odometer
+        log = np.array([[value or 0 for value in row] for row in rows], dtype=np.float64)
+        timestamp, soc, charging, odometer = log.T
+
+        gap_hours = np.diff(timestamp) / 3600
+        soc_gain = np.diff(soc)
+        start_soc = soc[:-1]
+        both_charging = (charging[:-1] == 1) & (charging[1:] == 1)
+        both_driving = (charging[:-1] == 0) & (charging[1:] == 0)
+
+        # charging samples: charge rate at the middle of the interval
+        is_charge = both_charging & (gap_hours > 0) & (gap_hours <= self.CHARGE_MAX_SAMPLE_GAP_HOURS) & (soc_gain > 0)
+        rate = soc_gain[is_charge] / gap_hours[is_charge]
+        mid_soc = start_soc[is_charge] + soc_gain[is_charge] / 2
+        is_dc = rate >= self.DC_MIN_RATE_PERCENT_PER_HOUR
+        self.accumulate("charge_ac", self.get_charge_features(mid_soc[~is_dc]), rate[~is_dc],
+                        gap_hours[is_charge][~is_dc])
+        self.accumulate("charge_dc", self.get_charge_features(mid_soc[is_dc]), rate[is_dc],
+                        gap_hours[is_charge][is_dc])
+
+        # driving samples: km per battery percent, weighted by the percents used
+        distance = np.diff(odometer)
+        is_drive = (both_driving & (gap_hours > 0) & (gap_hours <= self.DRIVE_MAX_SAMPLE_GAP_HOURS)
+                    & (distance > 0) & (soc_gain < 0) & (odometer[:-1] > 0))
+        soc_used = -soc_gain[is_drive]
+        self.accumulate("range", self.get_range_features(timestamp[1:][is_drive]), distance[is_drive] / soc_used,
+                        soc_used)
+
+        logging.debug(f"predictor: {is_charge.sum()} charging and {is_drive.sum()} driving samples added")
+
+    @staticmethod
+    def get_charge_features(soc: np.ndarray) -> np.ndarray:
+        """
+        Quadratic charging curve: rate = a + b.soc + c.soc², soc scaled to [0, 1]
+        """
+        soc = soc / 100
+        return np.column_stack((np.ones_like(soc), soc, soc ** 2))
+
+    @staticmethod
+    def get_range_features(unix_timestamp: np.ndarray) -> np.ndarray:
+        """
+        km per percent = a + b.cos(day of year) + c.sin(day of year): winter consumption is higher
+        """
+        year_angle = 2 * np.pi * (unix_timestamp / 86400 % 365.25) / 365.25
+        return np.column_stack((np.ones_like(year_angle), np.cos(year_angle), np.sin(year_angle)))
+
+    def accumulate(self, model: str, features: np.ndarray, target: np.ndarray, weights: np.ndarray):
+        samples, xtx, xty = self.statistics[model]
+        weighted_features = features * weights[:, None]
+        self.statistics[model] = (samples + len(target),
+                                  xtx + weighted_features.T @ features,
+                                  xty + weighted_features.T @ target)
+
+    def fit(self):
+        for model, (samples, xtx, xty) in self.statistics.items():
+            if samples < self.MIN_SAMPLES:
+                self.parameters[model] = None
+                continue
+
+            regularization = self.RIDGE * max(np.trace(xtx), 1) * np.eye(len(xty))
+            self.parameters[model] = np.linalg.solve(xtx + regularization, xty)
+
+    def predict_charge_minutes(self, soc: float, target_soc: float, dc: bool) -> [float, None]:
+        """
+        Predicts the charging time by integrating the charging curve from soc to target_soc, per 0.5%
+        :return: minutes, None if the model does not have enough samples yet
+        """
+        if self.statistics is None:
+            self.load()
+
+        parameters = self.parameters["charge_dc" if dc else "charge_ac"]
+        if parameters is None:
+            return None
+
+        if target_soc <= soc:
+            return 0
+
+        step = 0.5
+        steps_soc = np.arange(soc, target_soc, step) + step / 2
+        rate = np.maximum(self.get_charge_features(steps_soc) @ parameters, self.MIN_RATE_PERCENT_PER_HOUR)
+
+        return float(np.sum(step / rate) * 60)
+
+    def predict_range_km(self, soc: float, date: datetime.datetime = None) -> [float, None]:
+        """
+        :return: predicted range in km for the given state of charge and date, None if not enough samples yet
+        """
+        if self.statistics is None:
+            self.load()
+
+        parameters = self.parameters["range"]
+        if parameters is None:
+            return None
+
+        date = date or datetime.datetime.now()
+        km_per_percent = self.get_range_features(np.array([date.timestamp()])) @ parameters
+
+        return float(max(km_per_percent[0], 0) * soc)
@@ -6,8 +6,12 @@ from enum import Enum
 from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 
+from Account import Account
+from ConsumptionAnalytics import ConsumptionAnalytics
 from DatabaseClient import DatabaseClient
-from hyundai_kia_connect_api import Vehicle, VehicleManager
+from PollScheduler import PollScheduler
+from Predictor import Predictor
+from hyundai_kia_connect_api import Vehicle
 from hyundai_kia_connect_api.exceptions import RateLimitingError, APIError, RequestTimeoutError
 
 
@@ -17,6 +21,13 @@ class ChargeType(Enum):
     UNKNOWN = "UNKNOWN"
 
 
+class ApiBudgetExceededError(Exception):
+    """
+    Raised instead of making an API call when the account has used its daily API budget
+    """
+    pass
+
+
 class VehicleClient:
     """
     Vehicle client class
@@ -25,12 +36,24 @@ class VehicleClient:
     - handle additional (calculated) attributes that the API does not provide
     """
 
-    def __init__(self):
+    def __init__(self, account: Account = None, vehicle_id: str = None):
+        """
+        :param account: account the vehicle belongs to. defaults to the account defined in the .env file
+        :param vehicle_id: vehicle UUID. defaults to KIA_VEHICLE_UUID
+        """
 
         # load env vars from .env file
         load_dotenv()
 
+        self.account = account or Account.from_env()
+        self.vehicle_id = vehicle_id or os.environ["KIA_VEHICLE_UUID"]
+
         self.db_client = DatabaseClient(self)
+        # data saved before fleet mode belongs to the single vehicle defined in the .env file
+        self.db_client.migrate(os.environ.get("KIA_VEHICLE_UUID") or self.vehicle_id)
+        self.scheduler = PollScheduler(self.db_client)
+        self.analytics = ConsumptionAnalytics(self.db_client)
+        self.predictor = Predictor(self.db_client)
 
         self.interval_in_seconds: int = 3600 * 4  # default
         self.charging_power_in_kilowatts: int = 0  # default = 0 (not charging)
@@ -39,6 +62,7 @@ class VehicleClient:
         self.vm = None
         self.logger = None
         self.trips = None  # vehicle trips. better motel than the one in the library
+        self.last_action_id = None  # ID of the last command sent to the vehicle
 
         # interval in seconds between checks for cached requests
         # we are limited to 200 requests a day, including cached
@@ -48,13 +72,17 @@ class VehicleClient:
 
         self.CAR_OFF_FORCE_REFRESH_INTERVAL = 3600 * 6
 
+        # when the car is off, force refreshes are spread by the scheduler where trips and charging sessions
+        # usually start. the budget matches the fixed interval above (4 a day), only the timing changes.
+        self.CAR_OFF_DAILY_FORCE_REFRESH_BUDGET = 24 * 3600 / self.CAR_OFF_FORCE_REFRESH_INTERVAL
+        self.CAR_OFF_MIN_FORCE_REFRESH_INTERVAL = 1800
+        self.CAR_OFF_MAX_FORCE_REFRESH_INTERVAL = 3600 * 12
+
         self.ENGINE_RUNNING_FORCE_REFRESH_INTERVAL = 600
         self.DC_CHARGE_FORCE_REFRESH_INTERVAL = 1800
         self.AC_CHARGE_FORCE_REFRESH_INTERVAL = 1800
 
-        self.vm = VehicleManager(region=1, brand=1, username=os.environ["KIA_USERNAME"],
-                                 password=os.environ["KIA_PASSWORD"],
-                                 pin="")
+        self.vm = self.account.vm
 
     def get_estimated_charging_power(self):
         """
@@ -168,6 +196,7 @@ class VehicleClient:
 
         for yyyymm in months_list:
             try:
+                self.spend_api_call()
                 self.vm.update_month_trip_info(self.vehicle.id, yyyymm)
             except Exception as e:
                 self.handle_api_exception(e)
@@ -176,12 +205,14 @@ class VehicleClient:
             if self.vehicle.month_trip_info is not None:
                 for day in self.vehicle.month_trip_info.day_list:  # ordered on day
                     # warning: this causes an API call.
-                    # skip this day if already saved in db
-                    if datetime.datetime.strptime(day.yyyymmdd,
-                                                  "%Y%m%d") < self.db_client.get_most_recent_saved_trip_timestamp():
+                    # skip this day if already saved in db. a new vehicle has no saved trips yet
+                    most_recent_saved_trip = (self.db_client.get_most_recent_saved_trip_timestamp()
+                                              or datetime.datetime.min)
+                    if datetime.datetime.strptime(day.yyyymmdd, "%Y%m%d") < most_recent_saved_trip:
                         continue
 
                     try:
+                        self.spend_api_call()
                         self.vm.update_day_trip_info(self.vehicle.id, day.yyyymmdd)
                     except Exception as e:
                         self.handle_api_exception(e)
@@ -208,6 +239,18 @@ class VehicleClient:
 
         self.db_client.save_log()
 
+        # learn from the new data point
+        self.predictor.update()
+
+    def spend_api_call(self):
+        """
+        Counts an API call against the account's daily budget. Must be called right before each API call.
+        Refused calls are not counted.
+        """
+        if not self.db_client.count_api_call(self.account.name, self.account.daily_api_budget):
+            raise ApiBudgetExceededError(f"account {self.account.name} used its daily API budget "
+                                         f"({self.account.daily_api_budget} calls)")
+
     def handle_api_exception(self, exc: Exception):
         """
         In case of API error, this function defines what to do:
@@ -225,6 +268,11 @@ class VehicleClient:
             # time.sleep(3600 * 4)
             return
 
+        # our own budget is exhausted: no API call was made, nothing to log in the errors table
+        elif isinstance(exc, ApiBudgetExceededError):
+            self.logger.warning(str(exc))
+            return
+
         # request timeout: vehicle could not be reached.
         # to prevent too many unsuccessful requests in a row (which would lead to rate limiting) we sleep for a while.
         elif isinstance(exc, RequestTimeoutError):
@@ -255,22 +303,18 @@ class VehicleClient:
     def refresh(self):
         self.logger.info("refreshing token...")
 
-        if len(self.vm.vehicles) == 0 and self.vm.token:
-            # supposed bug in lib: if initialization fails due to rate limiting, vehicles list is never filled
-            # reset token to login again, the lib will then fill the list correctly
-            self.vm.token = None
-        # this command does NOT refresh vehicles (at least for EU and if there is not a preexisting token)
         try:
-            self.vm.check_and_refresh_token()
+            self.account.check_and_refresh_token()
         except Exception as e:
             self.handle_api_exception(e)
             return
 
-        self.vehicle = self.vm.get_vehicle(os.environ["KIA_VEHICLE_UUID"])
+        self.vehicle = self.vm.get_vehicle(self.vehicle_id)
         # fetch cached status, but do not retrieve driving info (driving stats) just yet, to prevent making too
         # many API calls. yes, cached calls also increment the API limit counter.
 
         try:
+            self.spend_api_call()
             response = self.vm.api._get_cached_vehicle_state(self.vm.token, self.vehicle)
         except Exception as e:
             self.handle_api_exception(e)
@@ -282,22 +326,36 @@ class VehicleClient:
 
         self.set_interval()
 
+        # materializes the consumption tables of a vehicle that has none yet, without waiting for it to drive
+        if not self.analytics.loaded:
+            self.analytics.load()
+
         # compare odometers. higher odo means we drove and new data must be pulled
         if self.vehicle.odometer > self.db_client.get_last_update_odometer():
             # it's not time to force refresh yet, but we might still have data on the server
             # that is more recent that our last saved data, so we save it
 
             try:
+                self.spend_api_call()
                 response = self.vm.api._get_driving_info(self.vm.token, self.vehicle)
             except Exception as e:
                 self.handle_api_exception(e)
                 return
 
             self.vm.api._update_vehicle_drive_info(self.vehicle, response)
+            # daily stats and trips are only saved from these days on: the analytics are refreshed from there
+            changed_since = min([day.date.strftime("%Y-%m-%d") for day in self.vehicle.daily_stats]
+                                + [(self.db_client.get_most_recent_saved_trip_timestamp()
+                                    or datetime.datetime(2020, 1, 1)).strftime("%Y-%m-%d")])
             self.db_client.save_daily_stats()
             self.get_estimated_charging_power()
             # process_trips() does at least 2 API calls even when there are no new trips.
             self.process_trips()
+            # feed the newly saved trips to the scheduler
+            self.scheduler.update()
+            self.set_interval()
+            # update the consumption tables with the new daily stats and trips
+            self.analytics.refresh(changed_since)
 
         db_last_update_ts = self.db_client.get_last_update_timestamp()
 
@@ -318,6 +376,7 @@ class VehicleClient:
         if delta.total_seconds() > self.interval_in_seconds:
             self.logger.info("Performing force refresh...")
             try:
+                self.spend_api_call()
                 self.vm.force_refresh_vehicle_state(self.vehicle.id)
             except Exception as e:
                 self.handle_api_exception(e)
@@ -326,6 +385,7 @@ class VehicleClient:
             self.logger.info(f"Data received by server. Now retrieving from server...")
 
             try:
+                self.spend_api_call()
                 self.vm.update_vehicle_with_cached_state(self.vehicle.id)
             except Exception as e:
                 self.handle_api_exception(e)
@@ -351,5 +411,7 @@ class VehicleClient:
             elif self.charge_type in (ChargeType.AC, ChargeType.UNKNOWN):
                 self.interval_in_seconds = self.AC_CHARGE_FORCE_REFRESH_INTERVAL
         else:
-            # car is off
-            self.interval_in_seconds = self.CAR_OFF_FORCE_REFRESH_INTERVAL
+            # car is off: poll more often at times when the car usually starts driving or charging
+            self.interval_in_seconds = self.scheduler.get_interval(self.CAR_OFF_DAILY_FORCE_REFRESH_BUDGET,
+                                                                   self.CAR_OFF_MIN_FORCE_REFRESH_INTERVAL,
+                                                                   self.CAR_OFF_MAX_FORCE_REFRESH_INTERVAL)
@@ -0,0 +1,29 @@
+import argparse
+import logging
+
+import coloredlogs
+from dotenv import load_dotenv
+
+# VehicleClient must be imported first: it imports DatabaseClient, which imports it back
+import VehicleClient  # noqa: F401
+from DatabaseClient import DatabaseClient
+
+logger = logging.getLogger(__name__)
+coloredlogs.install(level='DEBUG', isatty=True)
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Move old log rows to monthly compressed archives")
+
+    parser.add_argument("--hot-months", type=int, help="number of months kept in the main database")
+    args = parser.parse_args()
+
+    db_client = DatabaseClient(None)
+
+    if args.hot_months:
+        db_client.HOT_MONTHS = args.hot_months
+
+    logger.warning(f"Grafana dashboards will not show the log older than {db_client.HOT_MONTHS} months anymore")
+
+    db_client.archive_old_months()
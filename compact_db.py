@@ -0,0 +1,158 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+
+import coloredlogs
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+coloredlogs.install(level='DEBUG', isatty=True)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_schema.sql")
+
+# log queries of the Grafana dashboards, used to measure scan times before and after conversion
+GRAFANA_QUERIES = [
+    "select unix_last_vehicle_update_timestamp, battery_percentage, ac_charge_limit_percent, dc_charge_limit_percent "
+    "from log;",
+    "select unix_last_vehicle_update_timestamp, estimated_range_km from log;",
+    "select unix_last_vehicle_update_timestamp, accessory_battery_percentage from log;",
+    "select unix_last_vehicle_update_timestamp, rough_charging_power_estimate_kw from log;",
+    "select unix_last_vehicle_update_timestamp, charging from log;",
+    "select odometer, unix_last_vehicle_update_timestamp from log;",
+    "select battery_percentage from log order by unix_timestamp desc limit 1;",
+    "select unix_last_vehicle_update_timestamp, target_climate_temperature from log;",
+    "select latitude, longitude, battery_percentage from log;",
+]
+
+# full scan of the status columns, without the cost of returning the rows to python
+SCAN_QUERY = "select count(*), sum(battery_percentage), sum(unix_last_vehicle_update_timestamp), sum(charging) " \
+             "from log;"
+
+# columns of the v1 log table that are written to the v2 schema, through the log view
+V1_COLUMNS = ["vehicle_id",
+              "unix_timestamp",
+              "unix_last_vehicle_update_timestamp",
+              "battery_percentage",
+              "accessory_battery_percentage",
+              "estimated_range_km",
+              "latitude",
+              "longitude",
+              "odometer",
+              "charging",
+              "engine_is_running",
+              "rough_charging_power_estimate_kw",
+              "ac_charge_limit_percent",
+              "dc_charge_limit_percent",
+              "target_climate_temperature",
+              "raw_api_data"]
+
+
+def measure(db_path: str, repeat: int = 5) -> tuple:
+    """
+    Measures the file size, the time it takes to run all the Grafana log queries and the time of a full scan
+    (best of several runs)
+    :return: size in bytes, Grafana queries time in seconds, scan time in seconds
+    """
+    conn = sqlite3.connect(db_path)
+
+    def best_time(queries: list) -> float:
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            for query in queries:
+                conn.execute(query).fetchall()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    grafana_time = best_time(GRAFANA_QUERIES)
+    scan_time = best_time([SCAN_QUERY])
+
+    conn.close()
+
+    return os.path.getsize(db_path), grafana_time, scan_time
+
+
+def convert(conn: sqlite3.Connection, default_vehicle_id: str):
+    """
+    Converts the v1 log table to the v2 schema, in place.
+    Rows are copied through the log compatibility view, so its insert trigger does the conversion.
+    """
+    cur = conn.cursor()
+
+    cur.execute("SELECT type FROM sqlite_master WHERE name = 'log';")
+    if cur.fetchone()[0] == 'view':
+        logger.info("log is already in the v2 format")
+        return
+
+    # databases from before fleet mode
+    columns = [row[1] for row in cur.execute('PRAGMA table_info(log);')]
+    if "vehicle_id" not in columns:
+        cur.execute('ALTER TABLE log ADD COLUMN vehicle_id TEXT;')
+        cur.execute('UPDATE log SET vehicle_id = ?;', (default_vehicle_id,))
+
+    cur.execute('ALTER TABLE log RENAME TO log_v1;')
+    # every statement of the schema is "IF NOT EXISTS": only the v2 log objects are created
+    with open(SCHEMA_PATH) as schema_file:
+        cur.executescript(schema_file.read())
+
+    column_list = ", ".join(V1_COLUMNS)
+    cur.execute('SELECT COUNT(*) FROM log_v1;')
+    v1_rows = cur.fetchone()[0]
+
+    logger.info(f"converting {v1_rows} log rows...")
+    cur.execute(f'INSERT INTO log({column_list}) SELECT {column_list} FROM log_v1 ORDER BY unix_timestamp;')
+
+    cur.execute('SELECT COUNT(*) FROM log_v2;')
+    v2_rows = cur.fetchone()[0]
+    if v2_rows != v1_rows:
+        # the v2 key is (time, vehicle): only one of the rows saved in the same second for a vehicle is kept
+        logger.warning(f"{v1_rows - v2_rows} rows saved in the same second as another row of their vehicle "
+                       f"were dropped")
+
+    cur.execute('DROP TABLE log_v1;')
+    conn.commit()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Convert a database to the compact v2 log schema and vacuum it. "
+                                                 "Run it while the daemon and the HTTP server are stopped.")
+
+    parser.add_argument("source", nargs="?", default=os.environ.get("KIA_DB_PATH"), help="default: KIA_DB_PATH")
+    parser.add_argument("--output", help="converted database path. default: <source>.v2")
+    parser.add_argument("--vehicle-id", default=os.environ.get("KIA_VEHICLE_UUID") or "",
+                        help="vehicle of rows saved before fleet mode. default: KIA_VEHICLE_UUID")
+    args = parser.parse_args()
+
+    if not args.source or not os.path.exists(args.source):
+        raise FileNotFoundError(f"DB file not found: {args.source}")
+
+    output = args.output or args.source + ".v2"
+    if os.path.exists(output):
+        raise FileExistsError(f"output file already exists: {output}")
+
+    # the source database is never modified: work on a copy
+    source_conn = sqlite3.connect(args.source)
+    output_conn = sqlite3.connect(output)
+    source_conn.backup(output_conn)
+    source_conn.close()
+
+    convert(output_conn, args.vehicle_id)
+
+    logger.info("vacuuming...")
+    output_conn.execute('VACUUM;')
+    output_conn.close()
+
+    size_before, grafana_time_before, scan_time_before = measure(args.source)
+    size_after, grafana_time_after, scan_time_after = measure(output)
+
+    logger.info(f"size: {size_before / 1024 / 1024:.1f} MiB -> {size_after / 1024 / 1024:.1f} MiB "
+                f"({100 * size_after / size_before:.0f}%)")
+    logger.info(f"Grafana log queries: {grafana_time_before * 1000:.0f} ms -> {grafana_time_after * 1000:.0f} ms "
+                f"({100 * grafana_time_after / grafana_time_before:.0f}%)")
+    logger.info(f"log full scan: {scan_time_before * 1000:.1f} ms -> {scan_time_after * 1000:.1f} ms "
+                f"({100 * scan_time_after / scan_time_before:.0f}%)")
+    logger.info(f"done. replace {args.source} with {output} to use it.")
@@ -10,33 +10,99 @@ CREATE TABLE IF NOT EXISTS "stats_per_day" (
 	"regenerated_energy_kwh"	REAL,
 	"distance"	INTEGER,
 	"average_consumption_kwh"	REAL,
-	"average_consumption_regen_deducted_kwh"	REAL
+	"average_consumption_regen_deducted_kwh"	REAL,
+	"vehicle_id"	TEXT
 );
-CREATE TABLE IF NOT EXISTS "log" (
+CREATE TABLE IF NOT EXISTS "vehicles" (
+	"id"	INTEGER PRIMARY KEY,
+	"uuid"	TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS "log_v2" (
+	"unix_timestamp"	INTEGER NOT NULL,
+	"vehicle"	INTEGER NOT NULL,
+	"unix_last_vehicle_update_timestamp"	INTEGER,
 	"battery_percentage"	INTEGER,
 	"accessory_battery_percentage"	INTEGER,
 	"estimated_range_km"	INTEGER,
-	"timestamp"	TEXT,
-	"unix_timestamp"	INTEGER,
-	"last_vehicule_update_timestamp"	TEXT,
-	"unix_last_vehicle_update_timestamp"	INTEGER,
-	"latitude"	TEXT,
-	"longitude"	TEXT,
+	"latitude_e6"	INTEGER,
+	"longitude_e6"	INTEGER,
 	"odometer"	INTEGER,
 	"charging"	INTEGER,
 	"engine_is_running"	INTEGER,
 	"rough_charging_power_estimate_kw"	REAL,
-	"returned_api_status"	TEXT,
 	"ac_charge_limit_percent"	INTEGER,
 	"dc_charge_limit_percent"	INTEGER,
-	"target_climate_temperature"	INTEGER,
-	"raw_api_data"	TEXT
-);
+	"target_climate_temperature"	REAL,
+	PRIMARY KEY("unix_timestamp","vehicle")
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS "log_raw_v2" (
+	"unix_timestamp"	INTEGER NOT NULL,
+	"vehicle"	INTEGER NOT NULL,
+	"raw_api_data"	TEXT,
+	PRIMARY KEY("unix_timestamp","vehicle")
+) WITHOUT ROWID;
+CREATE VIEW IF NOT EXISTS "log" AS
+SELECT
+	l.battery_percentage,
+	l.accessory_battery_percentage,
+	l.estimated_range_km,
+	datetime(l.unix_timestamp, 'unixepoch', 'localtime') AS timestamp,
+	l.unix_timestamp,
+	datetime(l.unix_last_vehicle_update_timestamp, 'unixepoch', 'localtime') AS last_vehicule_update_timestamp,
+	l.unix_last_vehicle_update_timestamp,
+	l.latitude_e6 / 1000000.0 AS latitude,
+	l.longitude_e6 / 1000000.0 AS longitude,
+	l.odometer,
+	l.charging,
+	l.engine_is_running,
+	l.rough_charging_power_estimate_kw,
+	NULL AS returned_api_status,
+	l.ac_charge_limit_percent,
+	l.dc_charge_limit_percent,
+	l.target_climate_temperature,
+	(SELECT r.raw_api_data FROM log_raw_v2 AS r
+		WHERE r.unix_timestamp = l.unix_timestamp AND r.vehicle = l.vehicle) AS raw_api_data,
+	NULLIF(v.uuid, '') AS vehicle_id,
+	l.vehicle
+FROM log_v2 AS l
+LEFT JOIN vehicles AS v ON v.id = l.vehicle;
+CREATE TRIGGER IF NOT EXISTS "log_insert" INSTEAD OF INSERT ON "log"
+BEGIN
+	INSERT OR IGNORE INTO vehicles(uuid) VALUES(COALESCE(NEW.vehicle_id, ''));
+	INSERT OR REPLACE INTO log_v2 VALUES(
+		NEW.unix_timestamp,
+		(SELECT id FROM vehicles WHERE uuid = COALESCE(NEW.vehicle_id, '')),
+		NEW.unix_last_vehicle_update_timestamp,
+		NEW.battery_percentage,
+		NEW.accessory_battery_percentage,
+		NEW.estimated_range_km,
+		CAST(round(NULLIF(NEW.latitude, '') * 1000000) AS INTEGER),
+		CAST(round(NULLIF(NEW.longitude, '') * 1000000) AS INTEGER),
+		NEW.odometer,
+		NEW.charging,
+		NEW.engine_is_running,
+		NEW.rough_charging_power_estimate_kw,
+		NEW.ac_charge_limit_percent,
+		NEW.dc_charge_limit_percent,
+		NEW.target_climate_temperature
+	);
+	INSERT OR REPLACE INTO log_raw_v2
+	SELECT NEW.unix_timestamp, id, NEW.raw_api_data FROM vehicles
+	WHERE uuid = COALESCE(NEW.vehicle_id, '') AND NEW.raw_api_data IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS "log_delete" INSTEAD OF DELETE ON "log"
+BEGIN
+	DELETE FROM log_v2 WHERE unix_timestamp = OLD.unix_timestamp
+		AND vehicle = (SELECT id FROM vehicles WHERE uuid = COALESCE(OLD.vehicle_id, ''));
+	DELETE FROM log_raw_v2 WHERE unix_timestamp = OLD.unix_timestamp
+		AND vehicle = (SELECT id FROM vehicles WHERE uuid = COALESCE(OLD.vehicle_id, ''));
+END;
 CREATE TABLE IF NOT EXISTS "errors" (
 	"timestamp"	TEXT,
 	"unix_timestamp"	INTEGER,
 	"exc_type"	TEXT,
-	"exc_args"	TEXT
+	"exc_args"	TEXT,
+	"vehicle_id"	TEXT
 );
 CREATE TABLE IF NOT EXISTS "trips" (
 	"unix_timestamp"	INTEGER,
@@ -45,6 +111,69 @@ CREATE TABLE IF NOT EXISTS "trips" (
 	"idle_time_minutes"	INTEGER,
 	"distance_km"	INTEGER,
 	"avg_speed_kmh"	INTEGER,
-	"max_speed_kmh"	INTEGER
+	"max_speed_kmh"	INTEGER,
+	"vehicle_id"	TEXT
+);
+CREATE TABLE IF NOT EXISTS "poll_model" (
+	"vehicle_id"	TEXT,
+	"hour_of_week"	INTEGER,
+	"event_count"	REAL,
+	PRIMARY KEY("vehicle_id","hour_of_week")
+);
+CREATE TABLE IF NOT EXISTS "poll_model_watermark" (
+	"vehicle_id"	TEXT PRIMARY KEY,
+	"last_trip_unix_timestamp"	INTEGER,
+	"last_log_unix_timestamp"	INTEGER,
+	"last_charging"	INTEGER
+);
+CREATE TABLE IF NOT EXISTS "api_usage" (
+	"account"	TEXT,
+	"date"	TEXT,
+	"calls"	INTEGER,
+	PRIMARY KEY("account","date")
+);
+CREATE TABLE IF NOT EXISTS "consumption_per_day" (
+	"vehicle_id"	TEXT,
+	"date"	TEXT,
+	"unix_timestamp"	INTEGER,
+	"efficiency_kwh_100km"	REAL,
+	"efficiency_regen_deducted_kwh_100km"	REAL,
+	"climate_share_percent"	REAL,
+	"drivetrain_share_percent"	REAL,
+	"rolling_7d_efficiency_kwh_100km"	REAL,
+	"rolling_30d_efficiency_kwh_100km"	REAL,
+	PRIMARY KEY("vehicle_id","date")
+);
+CREATE TABLE IF NOT EXISTS "consumption_per_month_of_year" (
+	"vehicle_id"	TEXT,
+	"month"	INTEGER,
+	"distance_km"	REAL,
+	"efficiency_kwh_100km"	REAL,
+	PRIMARY KEY("vehicle_id","month")
+);
+CREATE TABLE IF NOT EXISTS "consumption_per_speed" (
+	"vehicle_id"	TEXT,
+	"speed_bucket_kmh"	INTEGER,
+	"trips"	INTEGER,
+	"distance_km"	REAL,
+	"driving_time_minutes"	REAL,
+	"estimated_kwh"	REAL,
+	"efficiency_kwh_100km"	REAL,
+	PRIMARY KEY("vehicle_id","speed_bucket_kmh")
+);
+CREATE TABLE IF NOT EXISTS "prediction_models" (
+	"vehicle_id"	TEXT,
+	"model"	TEXT,
+	"samples"	INTEGER,
+	"xtx"	TEXT,
+	"xty"	TEXT,
+	PRIMARY KEY("vehicle_id","model")
+);
+CREATE TABLE IF NOT EXISTS "prediction_watermark" (
+	"vehicle_id"	TEXT PRIMARY KEY,
+	"unix_last_vehicle_update_timestamp"	INTEGER,
+	"battery_percentage"	INTEGER,
+	"charging"	INTEGER,
+	"odometer"	INTEGER
 );
 COMMIT;
@@ -4,9 +4,12 @@ import time
 from functools import wraps
 
 from dotenv import load_dotenv
-from flask import Flask, request, make_response, jsonify
+from flask import Flask, Response, request, make_response, jsonify
 
-from VehicleClient import VehicleClient
+# VehicleClient must be imported first: it imports DatabaseClient, which imports it back
+from VehicleClient import ApiBudgetExceededError
+from EventHub import EventHub
+from Fleet import Fleet
 from hyundai_kia_connect_api import ClimateRequestOptions
 from hyundai_kia_connect_api.const import OrderStatus
 from hyundai_kia_connect_api.exceptions import DeviceIDError, RateLimitingError
@@ -14,38 +17,191 @@ from hyundai_kia_connect_api.exceptions import DeviceIDError, RateLimitingError
 app = Flask(__name__)
 
 
-def auth_required(f):
+def password_required(f):
     """
-    Authentication decorator
+    Password check decorator, for routes that do not talk to the API
     Checks for the password passed as a GET argument.
     :param f: the function to decorate
     """
 
     @wraps(f)
     def decorator(*args, **kwargs):
-        # check password.
         # password is passed as a GET argument in the HTTP request.
         if request.args.get('password') != app.config["SERVER_PASSWORD"]:
             return make_response({"error": "invalid password"}, 401)
 
+        return f(*args, **kwargs)
+
+    return decorator
+
+
+def auth_required(f):
+    """
+    Authentication decorator
+    Checks for the password passed as a GET argument, and makes sure the API token is valid.
+    The vehicle is selected with the "vehicle" GET argument (UUID or name from the fleet configuration),
+    which may be omitted when there is a single vehicle. It is passed to the route as vehicle_client.
+    :param f: the function to decorate
+    """
+
+    @wraps(f)
+    @password_required
+    def decorator(*args, **kwargs):
+        vehicle_client = fleet.get_vehicle_client(request.args.get('vehicle'))
+        if vehicle_client is None:
+            return make_response({"error": "unknown vehicle, or vehicle argument missing"}, 404)
+
         for attempts in range(2):
-            vehicle_client.vm.check_and_refresh_token()
+            vehicle_client.account.check_and_refresh_token()
             try:
-                return f(*args, **kwargs)
+                return f(*args, vehicle_client=vehicle_client, **kwargs)
             except DeviceIDError:
                 # Workaround for "invalid deviceID": reset token, then relogin
                 # https://github.com/Hyundai-Kia-Connect/hyundai_kia_connect_api/issues/424#issuecomment-1752787621
                 vehicle_client.vm.token = None
+            except ApiBudgetExceededError as e:
+                return make_response({"error": str(e)}, 429)
             except Exception as e:
                 return make_response({"error": "something went wrong: " + str(e)}, 500)
 
     return decorator
 
 
+@app.route("/events")
+@password_required
+def stream_events():
+    """
+    Server-sent events stream of vehicle status changes.
+    Each event contains the status fields that changed since the previous log entry.
+    Available arguments:
+    - last_event_id: resume after this event (the Last-Event-ID header is used first when present)
+    - vehicle: only stream the events of this vehicle (UUID or name). default: all vehicles
+    """
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id is not None:
+        if not last_event_id.isdigit():
+            return make_response({"error": "invalid last event ID"}, 400)
+        last_event_id = int(last_event_id)
+
+    vehicle_id = None
+    if request.args.get('vehicle'):
+        vehicle_client = fleet.get_vehicle_client(request.args.get('vehicle'))
+        if vehicle_client is None:
+            return make_response({"error": "unknown vehicle"}, 404)
+        vehicle_id = vehicle_client.vehicle_id
+
+    return Response(event_hub.stream(last_event_id, vehicle_id),
+                    mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def get_percent_argument(name: str, default: [float, None]) -> [float, None]:
+    """
+    Returns a battery percentage GET argument, or the default if it was not passed
+    :raises ValueError: if it is not a number between 0 and 100
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+
+    value = float(value)
+    if not 0 <= value <= 100:
+        raise ValueError(f"{name} must be between 0 and 100")
+
+    return value
+
+
+@app.route("/predict/charge")
+@password_required
+def predict_charge():
+    """
+    Predicts the charging time from the vehicle's charging history, with the models fitted by the daemon.
+    Never calls the API.
+    Available arguments:
+    - vehicle
+    - soc: starting battery percentage. default: last logged
+    - target: target battery percentage. default: last logged charge limit
+    - type: [ac, dc] (default: ac)
+    """
+
+    vehicle_client = fleet.get_vehicle_client(request.args.get('vehicle'))
+    if vehicle_client is None:
+        return make_response({"error": "unknown vehicle, or vehicle argument missing"}, 404)
+
+    charge_type = request.args.get('type', 'ac')
+    if charge_type not in ('ac', 'dc'):
+        return make_response({"error": "type must be ac or dc"}, 400)
+    dc = charge_type == 'dc'
+
+    last_row = vehicle_client.db_client.get_last_vehicle_log_row(["battery_percentage",
+                                                                  "ac_charge_limit_percent",
+                                                                  "dc_charge_limit_percent"]) or {}
+
+    try:
+        soc = get_percent_argument('soc', last_row.get("battery_percentage"))
+        target = get_percent_argument('target',
+                                      last_row.get("dc_charge_limit_percent" if dc else "ac_charge_limit_percent"))
+    except ValueError:
+        return make_response({"error": "soc and target must be numbers between 0 and 100"}, 400)
+    if soc is None or target is None:
+        return make_response({"error": "soc and target are unknown, pass them as arguments"}, 400)
+
+    # the daemon updates the models when it saves a log entry: only read what it saved
+    vehicle_client.predictor.load()
+    minutes = vehicle_client.predictor.predict_charge_minutes(soc, target, dc)
+    if minutes is None:
+        return make_response({"error": "not enough charging history yet"}, 503)
+
+    return jsonify({"soc": soc,
+                    "target": target,
+                    "type": "dc" if dc else "ac",
+                    "minutes": round(minutes),
+                    "estimated_end_timestamp": int(time.time() + minutes * 60)})
+
+
+@app.route("/predict/range")
+@password_required
+def predict_range():
+    """
+    Predicts the range from the vehicle's driving history, for the current time of year, with the models fitted by the
+    daemon. Never calls the API.
+    Available arguments:
+    - vehicle
+    - soc: battery percentage. default: last logged
+    """
+
+    vehicle_client = fleet.get_vehicle_client(request.args.get('vehicle'))
+    if vehicle_client is None:
+        return make_response({"error": "unknown vehicle, or vehicle argument missing"}, 404)
+
+    last_row = vehicle_client.db_client.get_last_vehicle_log_row(["battery_percentage", "estimated_range_km"]) or {}
+
+    try:
+        soc = get_percent_argument('soc', last_row.get("battery_percentage"))
+    except ValueError:
+        return make_response({"error": "soc must be a number between 0 and 100"}, 400)
+    if soc is None:
+        return make_response({"error": "soc is unknown, pass it as an argument"}, 400)
+
+    # the daemon updates the models when it saves a log entry: only read what it saved
+    vehicle_client.predictor.load()
+    range_km = vehicle_client.predictor.predict_range_km(soc)
+    if range_km is None:
+        return make_response({"error": "not enough driving history yet"}, 503)
+
+    return jsonify({"soc": soc,
+                    "range_km": round(range_km),
+                    # the car's own estimate, only meaningful when soc was not passed
+                    "vehicle_estimated_range_km": last_row.get("estimated_range_km")})
+
+
 @app.route("/force_refresh")
 @auth_required
-def force_refresh():
+def force_refresh(vehicle_client):
+    vehicle_client.spend_api_call()
     vehicle_client.vm.force_refresh_vehicle_state(vehicle_client.vehicle.id)
+    vehicle_client.spend_api_call()
     vehicle_client.vm.update_vehicle_with_cached_state(vehicle_client.vehicle.id)
 
     vehicle_client.save_log()
@@ -55,8 +211,10 @@ def force_refresh():
 
 @app.route("/status")
 @auth_required
-def get_cached_status():
-    vehicle_client.vm.update_all_vehicles_with_cached_state()
+def get_cached_status(vehicle_client):
+    # only the requested vehicle: each vehicle of the account costs an API call
+    vehicle_client.spend_api_call()
+    vehicle_client.vm.update_vehicle_with_cached_state(vehicle_client.vehicle_id)
 
     if vehicle_client.vehicle.last_updated_at > vehicle_client.db_client.get_last_update_timestamp():
         vehicle_client.save_log()
@@ -78,8 +236,10 @@ def get_cached_status():
 
 @app.route("/battery")
 @auth_required
-def get_battery_soc():
-    vehicle_client.vm.update_all_vehicles_with_cached_state()
+def get_battery_soc(vehicle_client):
+    # only the requested vehicle: each vehicle of the account costs an API call
+    vehicle_client.spend_api_call()
+    vehicle_client.vm.update_vehicle_with_cached_state(vehicle_client.vehicle_id)
 
     if vehicle_client.vehicle.last_updated_at.replace(
             tzinfo=None) > vehicle_client.db_client.get_last_update_timestamp():
@@ -90,7 +250,7 @@ def get_battery_soc():
 
 @app.route("/charge")
 @auth_required
-def toggle_charge():
+def toggle_charge(vehicle_client):
     """
     Available arguments:
     - action: [start, stop]
@@ -102,14 +262,17 @@ def toggle_charge():
     status = OrderStatus.PENDING
 
     if action == "start":
-        os.environ["kia_action_id"] = vehicle_client.vm.start_charge(vehicle_client.vehicle.id)
+        vehicle_client.spend_api_call()
+        vehicle_client.last_action_id = vehicle_client.vm.start_charge(vehicle_client.vehicle.id)
     elif action == "stop":
-        os.environ["kia_action_id"] = vehicle_client.vm.stop_charge(vehicle_client.vehicle.id)
+        vehicle_client.spend_api_call()
+        vehicle_client.last_action_id = vehicle_client.vm.stop_charge(vehicle_client.vehicle.id)
     else:
         return f"unrecognised command: {action}. send start or stop."
 
     if wait_for_response:
-        status = vehicle_client.vm.check_action_status(vehicle_client.vehicle.id, os.environ["kia_action_id"],
+        vehicle_client.spend_api_call()
+        status = vehicle_client.vm.check_action_status(vehicle_client.vehicle.id, vehicle_client.last_action_id,
                                                        synchronous=True,
                                                        timeout=60)
 
@@ -118,7 +281,7 @@ def toggle_charge():
 
 @app.route("/climate")
 @auth_required
-def toggle_climate():
+def toggle_climate(vehicle_client):
     """
     Available arguments:
     - action: [start, stop]
@@ -137,14 +300,17 @@ def toggle_climate():
     status = OrderStatus.PENDING
 
     if action == "start":
-        os.environ["kia_action_id"] = vehicle_client.vm.start_climate(vehicle_client.vehicle.id, options)
+        vehicle_client.spend_api_call()
+        vehicle_client.last_action_id = vehicle_client.vm.start_climate(vehicle_client.vehicle.id, options)
     elif action == "stop":
-        os.environ["kia_action_id"] = vehicle_client.vm.stop_climate(vehicle_client.vehicle.id)
+        vehicle_client.spend_api_call()
+        vehicle_client.last_action_id = vehicle_client.vm.stop_climate(vehicle_client.vehicle.id)
     else:
         return f"unrecognised command: {action}. send start or stop."
 
     if wait_for_response:
-        status = vehicle_client.vm.check_action_status(vehicle_client.vehicle.id, os.environ["kia_action_id"],
+        vehicle_client.spend_api_call()
+        status = vehicle_client.vm.check_action_status(vehicle_client.vehicle.id, vehicle_client.last_action_id,
                                                        synchronous=True,
                                                        timeout=60)
 
@@ -153,7 +319,7 @@ def toggle_climate():
 
 @app.route("/doors")
 @auth_required
-def toggle_doors():
+def toggle_doors(vehicle_client):
     """
     Available arguments:
     - action: [lock, unlock]
@@ -165,14 +331,17 @@ def toggle_doors():
     status = OrderStatus.PENDING
 
     if action == "lock":
-        os.environ["kia_action_id"] = vehicle_client.vm.lock(vehicle_client.vehicle.id)
+        vehicle_client.spend_api_call()
+        vehicle_client.last_action_id = vehicle_client.vm.lock(vehicle_client.vehicle.id)
     elif action == "unlock":
-        os.environ["kia_action_id"] = vehicle_client.vm.unlock(vehicle_client.vehicle.id)
+        vehicle_client.spend_api_call()
+        vehicle_client.last_action_id = vehicle_client.vm.unlock(vehicle_client.vehicle.id)
     else:
         return f"unrecognised command: {action}. send lock or unlock."
 
     if wait_for_response:
-        status = vehicle_client.vm.check_action_status(vehicle_client.vehicle.id, os.environ["kia_action_id"],
+        vehicle_client.spend_api_call()
+        status = vehicle_client.vm.check_action_status(vehicle_client.vehicle.id, vehicle_client.last_action_id,
                                                        synchronous=True,
                                                        timeout=60)
 
@@ -181,13 +350,14 @@ def toggle_doors():
 
 @app.route("/last_action_status")
 @auth_required
-def get_last_action_status():
+def get_last_action_status(vehicle_client):
     """
     Get status of the last known sent command
     """
-    if os.environ.get("kia_action_id"):
+    if vehicle_client.last_action_id:
         try:
-            status = vehicle_client.vm.check_action_status(vehicle_client.vehicle.id, os.environ["kia_action_id"],
+            vehicle_client.spend_api_call()
+            status = vehicle_client.vm.check_action_status(vehicle_client.vehicle.id, vehicle_client.last_action_id,
                                                            synchronous=True,
                                                            timeout=20)
             return jsonify({"status": status.value})
@@ -207,16 +377,26 @@ if __name__ == "__main__":
     if not app.config["SERVER_PASSWORD"]:
         raise Exception("HTTP_SERVER_PASSWORD not set. Exiting.")
 
-    vehicle_client = VehicleClient()
+    fleet = Fleet()
+    fleet.set_logger(logging.getLogger(__name__))
 
-    while True:
-        try:
-            vehicle_client.vm.check_and_refresh_token()
-            break
-        except RateLimitingError:
-            logging.error("Got rate limited. Will try again in 1 hour.")
-            time.sleep(60 * 60)
+    # push log rows saved by the daemon or by this server to SSE subscribers.
+    # all vehicles share the same database, any of their database clients can be watched.
+    event_hub = EventHub(next(iter(fleet.vehicle_clients.values())).db_client)
+    for vehicle_client in fleet.vehicle_clients.values():
+        vehicle_client.db_client.log_listeners.append(event_hub.notify)
+    event_hub.start()
+
+    for account in fleet.get_accounts():
+        while True:
+            try:
+                account.check_and_refresh_token()
+                break
+            except RateLimitingError:
+                logging.error(f"Got rate limited on account {account.name}. Will try again in 1 hour.")
+                time.sleep(60 * 60)
 
-    vehicle_client.vehicle = vehicle_client.vm.get_vehicle(os.environ["KIA_VEHICLE_UUID"])
+    for vehicle_client in fleet.vehicle_clients.values():
+        vehicle_client.vehicle = vehicle_client.vm.get_vehicle(vehicle_client.vehicle_id)
 
-    app.run(port=8000, host='0.0.0.0', debug=True)
+    app.run(port=8000, host='0.0.0.0', debug=True, threaded=True)
@@ -0,0 +1,781 @@
+import abc
+import argparse
+import bisect
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+import traceback
+import types
+
+import coloredlogs
+import numpy as np
+
+# VehicleClient must be imported before DatabaseClient (circular import)
+import VehicleClient
+import DatabaseClient
+import PollScheduler
+import Predictor
+from Account import Account
+from hyundai_kia_connect_api import Vehicle
+from hyundai_kia_connect_api.ApiImpl import ApiImpl
+from hyundai_kia_connect_api.Token import Token
+from hyundai_kia_connect_api.Vehicle import DailyDrivingStats, DayTripCounts, DayTripInfo, MonthTripInfo, TripInfo
+
+logger = logging.getLogger(__name__)
+coloredlogs.install(level='INFO', isatty=True)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_schema.sql")
+
+REPLAY_VEHICLE_ID = "replay-vehicle"
+REPLAY_ACCOUNT = "replay"
+
+
+class VirtualClock:
+    """
+    Virtual time for the tracker modules
+    Role:
+    - replace datetime.datetime.now() and datetime.date.today() in the modules that read the current time
+    - advance time instantly, so that months of polling run in seconds
+    """
+
+    # modules whose "datetime" module is replaced while the clock is installed
+    PATCHED_MODULES = [VehicleClient, DatabaseClient, PollScheduler, Predictor]
+
+    def __init__(self, start: datetime.datetime):
+        """
+        :param start: naive local time, like the tracker's timestamps
+        """
+        self.now = start
+
+        clock = self
+
+        class VirtualDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.now if tz is None else clock.now.astimezone(tz)
+
+        class VirtualDate(datetime.date):
+            @classmethod
+            def today(cls):
+                return clock.now.date()
+
+        self.datetime_module = types.ModuleType("datetime")
+        self.datetime_module.__dict__.update(datetime.__dict__)
+        self.datetime_module.datetime = VirtualDatetime
+        self.datetime_module.date = VirtualDate
+
+    def advance(self, seconds: int):
+        self.now += datetime.timedelta(seconds=seconds)
+
+    def get_timestamp(self) -> int:
+        return int(self.now.timestamp())
+
+    @contextlib.contextmanager
+    def install(self):
+        for module in self.PATCHED_MODULES:
+            module.datetime = self.datetime_module
+        try:
+            yield self
+        finally:
+            for module in self.PATCHED_MODULES:
+                module.datetime = datetime
+
+
+class ReplaySource(abc.ABC):
+    """
+    Vehicle data served by the replay API
+    Role:
+    - keep the states uploaded by the car to the server over time. A cached state request returns the last upload,
+      a force refresh makes the car upload its current state
+    - serve the trips and daily stats available on the server at a given time
+
+    Subclasses fill the data and implement get_state().
+    """
+
+    def __init__(self):
+        self.start: [datetime.datetime, None] = None
+        self.end: [datetime.datetime, None] = None
+
+        self.upload_times: list = []  # unix timestamps at which the car uploaded its state, sorted
+        self.forced_at: [int, None] = None  # unix timestamp of the last force refresh
+
+        # yyyymmdd -> [(unix timestamp at which the trip is available on the server, TripInfo)]
+        self.trips_per_day: dict = {}
+        self.trip_days_per_month: dict = {}  # yyyymm -> sorted yyyymmdd list
+        # DailyDrivingStats sorted on the unix timestamp at which they are available on the server
+        self.daily_stats: list = []
+        self.daily_stats_times: list = []
+
+        # the API returns the stats of the last 30 days
+        self.DAILY_STATS_DAYS = 30
+
+    @abc.abstractmethod
+    def get_state(self, unix_timestamp: int) -> dict:
+        """
+        State of the car at the given time, keys: see SyntheticSource.make_state()
+        """
+
+    def get_cached_state(self, unix_timestamp: int) -> tuple:
+        """
+        :return: the last state uploaded to the server at the given time: (upload unix timestamp, state)
+        """
+        i = bisect.bisect_right(self.upload_times, unix_timestamp) - 1
+        updated_at = self.upload_times[i] if i >= 0 else int(self.start.timestamp())
+
+        if self.forced_at is not None and updated_at < self.forced_at <= unix_timestamp:
+            updated_at = self.forced_at
+
+        return updated_at, self.get_state(updated_at)
+
+    def force_refresh(self, unix_timestamp: int):
+        self.forced_at = unix_timestamp
+
+    def add_trip(self, start: datetime.datetime, available_at: int, trip: TripInfo):
+        yyyymmdd = start.strftime("%Y%m%d")
+        if yyyymmdd not in self.trips_per_day:
+            self.trips_per_day[yyyymmdd] = []
+            bisect.insort(self.trip_days_per_month.setdefault(yyyymmdd[:6], []), yyyymmdd)
+        self.trips_per_day[yyyymmdd].append((available_at, trip))
+
+    def get_trip_days(self, yyyymm: str, unix_timestamp: int) -> list:
+        days = []
+        for yyyymmdd in self.trip_days_per_month.get(yyyymm, []):
+            trip_count = sum(1 for available_at, trip in self.trips_per_day[yyyymmdd] if available_at <= unix_timestamp)
+            if trip_count > 0:
+                days.append(DayTripCounts(yyyymmdd=yyyymmdd, trip_count=trip_count))
+        return days
+
+    def get_trips(self, yyyymmdd: str, unix_timestamp: int) -> list:
+        return [trip for available_at, trip in self.trips_per_day.get(yyyymmdd, []) if available_at <= unix_timestamp]
+
+    def get_daily_stats(self, unix_timestamp: int) -> list:
+        oldest_date = datetime.datetime.fromtimestamp(unix_timestamp) - datetime.timedelta(days=self.DAILY_STATS_DAYS)
+
+        stats = []
+        i = bisect.bisect_right(self.daily_stats_times, unix_timestamp) - 1
+        while i >= 0 and self.daily_stats[i].date >= oldest_date:
+            stats.append(self.daily_stats[i])
+            i -= 1
+        return stats
+
+    def add_daily_stats(self, available_at: int, daily_stats: DailyDrivingStats):
+        self.daily_stats.append(daily_stats)
+        self.daily_stats_times.append(available_at)
+
+
+class SyntheticSource(ReplaySource):
+    """
+    Simulated vehicle, deterministic for a given seed:
+    - commutes on weekdays (with an occasional errand at lunch time), a long return trip on some weekend days
+    - charges at home (AC) in the evening when the battery is low, and on fast chargers (DC) during long trips
+    - consumption is higher in winter
+    The car uploads its state to the server when it starts or stops driving or charging, like the real one.
+    """
+
+    def __init__(self, start: datetime.datetime, days: int, seed: int = 0):
+        super().__init__()
+
+        self.start = start
+        self.end = start + datetime.timedelta(days=days)
+        self.random = random.Random(seed)
+
+        self.BATTERY_KWH = 64
+        self.AC_RATE_PERCENT_PER_HOUR = 15
+        self.DC_RATE_PERCENT_PER_HOUR = 60
+        self.AC_CHARGE_LIMIT_PERCENT = 80
+        self.DC_CHARGE_LIMIT_PERCENT = 80
+        self.HOME_CHARGE_BELOW_PERCENT = 50
+        self.DC_CHARGE_BELOW_PERCENT = 15
+        self.HOME = (50.8503, 4.3517)
+
+        # segments of driving or charging: (start, end, activity, start soc, end soc, start odometer, end odometer,
+        # end location). activity: "drive", "ac" or "dc"
+        self.segments: list = []
+        self.segment_starts: list = []
+        self.initial_soc = 80
+        self.initial_odometer = 10000
+
+        self.soc = self.initial_soc
+        self.odometer = self.initial_odometer
+        self.location = self.HOME
+        self.last_end = int(start.timestamp())
+        self.day_energy_wh = 0
+        self.day_distance = 0
+
+        for day in range(days):
+            self.plan_day(start.date() + datetime.timedelta(days=day))
+
+        self.upload_times = sorted({timestamp for segment in self.segments for timestamp in segment[:2]})
+
+    def get_km_per_percent(self, when: datetime.date) -> float:
+        # 1 in mid-january, -1 in mid-july
+        winter = math.cos(2 * math.pi * (when.timetuple().tm_yday - 15) / 365)
+        return 4.5 - 1.1 * winter
+
+    def plan_day(self, day: datetime.date):
+        midnight = datetime.datetime.combine(day, datetime.time())
+        hours = self.random.uniform
+
+        # (departure, distance in km, average speed, destination)
+        trips = []
+        if day.weekday() < 5:
+            work = (self.HOME[0] + hours(-0.2, 0.2), self.HOME[1] + hours(-0.2, 0.2))
+            commute_km = hours(18, 30)
+            trips.append((midnight + datetime.timedelta(hours=7.5 + hours(0, 1)), commute_km, hours(35, 55), work))
+            if self.random.random() < 0.3:
+                trips.append((midnight + datetime.timedelta(hours=12 + hours(0, 1)), hours(5, 12), hours(30, 40), work))
+            trips.append((midnight + datetime.timedelta(hours=17 + hours(0, 1.5)), commute_km, hours(35, 55),
+                          self.HOME))
+        elif self.random.random() < 0.4:
+            destination = (self.HOME[0] + hours(-1.5, 1.5), self.HOME[1] + hours(-1.5, 1.5))
+            distance = hours(80, 250)
+            trips.append((midnight + datetime.timedelta(hours=9 + hours(0, 2)), distance, hours(85, 100), destination))
+            trips.append((midnight + datetime.timedelta(hours=15 + hours(0, 2)), distance, hours(85, 100), self.HOME))
+        elif self.random.random() < 0.6:
+            trips.append((midnight + datetime.timedelta(hours=10 + hours(0, 6)), hours(5, 15), hours(30, 45),
+                          self.HOME))
+
+        self.day_energy_wh = 0
+        self.day_distance = 0
+        for departure, distance, speed, destination in trips:
+            self.drive(departure, distance, speed, destination)
+
+        if self.day_distance > 0:
+            self.add_day(midnight)
+
+        if self.soc < self.HOME_CHARGE_BELOW_PERCENT:
+            plug_in = midnight + datetime.timedelta(hours=20 + hours(0, 1))
+            self.charge(int(plug_in.timestamp()), "ac")
+
+    def drive(self, departure: datetime.datetime, distance: float, speed: float, destination: tuple):
+        km_per_percent = self.get_km_per_percent(departure.date())
+        start = max(int(departure.timestamp()), self.last_end + 600)
+
+        while distance > 0:
+            # stop at a fast charger when the battery runs low
+            leg = min(distance, max(self.soc - self.DC_CHARGE_BELOW_PERCENT, 0) * km_per_percent)
+            if leg > 0:
+                end = start + int(leg / speed * 3600)
+                self.add_segment(start, end, "drive", self.soc - leg / km_per_percent, leg,
+                                 destination if leg == distance else self.location)
+
+                trip_start = datetime.datetime.fromtimestamp(start)
+                self.add_trip(trip_start, end, TripInfo(hhmmss=trip_start.strftime("%H%M%S"),
+                                                        drive_time=round(leg / speed * 60),
+                                                        idle_time=self.random.randint(0, 5),
+                                                        distance=round(leg, 1),
+                                                        avg_speed=round(speed),
+                                                        max_speed=round(speed * self.random.uniform(1.3, 1.6))))
+                self.day_energy_wh += leg / km_per_percent * self.BATTERY_KWH * 10
+                self.day_distance += leg
+                distance -= leg
+                start = end
+
+            if distance > 0:
+                start = self.charge(start + 300, "dc") + 300
+
+    def charge(self, start: int, activity: str) -> int:
+        """
+        :return: end of the charge, unix timestamp
+        """
+        limit = self.DC_CHARGE_LIMIT_PERCENT if activity == "dc" else self.AC_CHARGE_LIMIT_PERCENT
+        rate = self.DC_RATE_PERCENT_PER_HOUR if activity == "dc" else self.AC_RATE_PERCENT_PER_HOUR
+
+        end = start + int((limit - self.soc) / rate * 3600)
+        self.add_segment(start, end, activity, limit, 0, self.location)
+        return end
+
+    def add_segment(self, start: int, end: int, activity: str, end_soc: float, distance: float, end_location: tuple):
+        self.segments.append((start, end, activity, self.soc, end_soc, self.odometer, self.odometer + distance,
+                              end_location))
+        self.segment_starts.append(start)
+        self.soc = end_soc
+        self.odometer += distance
+        self.location = end_location
+        self.last_end = end
+
+    def add_day(self, midnight: datetime.datetime):
+        winter = max(math.cos(2 * math.pi * (midnight.timetuple().tm_yday - 15) / 365), 0)
+        total = self.day_energy_wh
+        climate = total * (0.05 + 0.2 * winter)
+        electronics = total * 0.03
+
+        self.add_daily_stats(self.last_end, DailyDrivingStats(date=midnight,
+                                                              total_consumed=int(total),
+                                                              engine_consumption=int(total - climate - electronics),
+                                                              climate_consumption=int(climate),
+                                                              onboard_electronics_consumption=int(electronics),
+                                                              battery_care_consumption=0,
+                                                              regenerated_energy=int(total * 0.12),
+                                                              distance=round(self.day_distance, 1)))
+
+    def get_state(self, unix_timestamp: int) -> dict:
+        i = bisect.bisect_right(self.segment_starts, unix_timestamp) - 1
+        if i < 0:
+            return self.make_state(unix_timestamp, self.initial_soc, self.initial_odometer, None, self.HOME)
+
+        start, end, activity, start_soc, end_soc, start_odometer, end_odometer, end_location = self.segments[i]
+        if unix_timestamp >= end:
+            return self.make_state(unix_timestamp, end_soc, end_odometer, None, end_location)
+
+        progress = (unix_timestamp - start) / (end - start)
+        location = self.segments[i - 1][7] if i > 0 else self.HOME
+        return self.make_state(unix_timestamp,
+                               start_soc + (end_soc - start_soc) * progress,
+                               start_odometer + (end_odometer - start_odometer) * progress,
+                               activity,
+                               location)
+
+    def make_state(self, unix_timestamp: int, soc: float, odometer: float, activity: [str, None],
+                   location: tuple) -> dict:
+        charge_duration = 0
+        if activity in ("ac", "dc"):
+            limit = self.DC_CHARGE_LIMIT_PERCENT if activity == "dc" else self.AC_CHARGE_LIMIT_PERCENT
+            rate = self.DC_RATE_PERCENT_PER_HOUR if activity == "dc" else self.AC_RATE_PERCENT_PER_HOUR
+            charge_duration = max((limit - soc) / rate * 60, 1)
+
+        km_per_percent = self.get_km_per_percent(datetime.date.fromtimestamp(unix_timestamp))
+
+        return {"battery_percentage": int(soc),
+                "accessory_battery_percentage": 90,
+                "estimated_range_km": int(soc * km_per_percent),
+                "latitude": round(location[0], 6),
+                "longitude": round(location[1], 6),
+                "odometer": int(odometer),
+                "charging": activity in ("ac", "dc"),
+                "engine_is_running": activity == "drive",
+                "ac_charge_limit_percent": self.AC_CHARGE_LIMIT_PERCENT,
+                "dc_charge_limit_percent": self.DC_CHARGE_LIMIT_PERCENT,
+                "charge_duration_minutes": int(charge_duration),
+                "air_temperature": 21}
+
+
+class RecordedSource(ReplaySource):
+    """
+    Replays the log, trips and daily stats of a vehicle recorded in an existing database (opened read only).
+    A force refresh returns the last recorded state: nothing more is known about the car between log entries.
+    """
+
+    LOG_COLUMNS = ["battery_percentage",
+                   "accessory_battery_percentage",
+                   "estimated_range_km",
+                   "latitude",
+                   "longitude",
+                   "odometer",
+                   "charging",
+                   "engine_is_running",
+                   "ac_charge_limit_percent",
+                   "dc_charge_limit_percent",
+                   "target_climate_temperature"]
+
+    def __init__(self, db_path: str, vehicle_id: [str, None] = None):
+        super().__init__()
+
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        cur = conn.cursor()
+
+        # databases from before fleet mode have no vehicle_id column
+        vehicle_filter = ""
+        parameters = ()
+        if vehicle_id:
+            vehicle_filter = "WHERE vehicle_id = ?"
+            parameters = (vehicle_id,)
+
+        cur.execute(f'''SELECT unix_last_vehicle_update_timestamp, {", ".join(self.LOG_COLUMNS)} FROM log
+                    {vehicle_filter}
+                    ORDER BY unix_last_vehicle_update_timestamp;''', parameters)
+        self.states = {}  # upload unix timestamp -> state
+        for row in cur:
+            self.states[row[0]] = dict(zip(self.LOG_COLUMNS, row[1:]))
+        if not self.states:
+            raise ValueError(f"no log rows to replay in {db_path}")
+
+        self.upload_times = sorted(self.states)
+        self.start = datetime.datetime.fromtimestamp(self.upload_times[0])
+        self.end = datetime.datetime.fromtimestamp(self.upload_times[-1])
+
+        cur.execute(f'''SELECT unix_timestamp, driving_time_minutes, idle_time_minutes, distance_km, avg_speed_kmh,
+                    max_speed_kmh FROM trips {vehicle_filter} ORDER BY unix_timestamp;''', parameters)
+        for unix_timestamp, drive_time, idle_time, distance, avg_speed, max_speed in cur:
+            trip_start = datetime.datetime.fromtimestamp(unix_timestamp)
+            self.add_trip(trip_start, unix_timestamp + ((drive_time or 0) + (idle_time or 0)) * 60,
+                          TripInfo(hhmmss=trip_start.strftime("%H%M%S"), drive_time=drive_time, idle_time=idle_time,
+                                   distance=distance, avg_speed=avg_speed, max_speed=max_speed))
+
+        cur.execute(f'''SELECT date, total_consumed_kwh, engine_consumption_kwh, climate_consumption_kwh,
+                    onboard_electronics_consumption_kwh, battery_care_consumption_kwh, regenerated_energy_kwh, distance
+                    FROM stats_per_day {vehicle_filter} ORDER BY date;''', parameters)
+        for row in cur:
+            date = datetime.datetime.strptime(row[0], "%Y-%m-%d")
+            energy_wh = [int((value or 0) * 1000) for value in row[1:7]]
+            # a day is complete, and available, at its end
+            self.add_daily_stats(int((date + datetime.timedelta(days=1)).timestamp()) - 1,
+                                 DailyDrivingStats(date, *energy_wh, distance=row[7] or 0))
+
+        conn.close()
+
+    def get_state(self, unix_timestamp: int) -> dict:
+        i = max(bisect.bisect_right(self.upload_times, unix_timestamp) - 1, 0)
+        state = dict(self.states[self.upload_times[i]])
+
+        # the daemon writes values as SQL literals: fill the columns that were not recorded
+        for column, value in state.items():
+            if value is None and column not in ("latitude", "longitude"):
+                state[column] = 0
+
+        state["charging"] = bool(state["charging"])
+        state["engine_is_running"] = bool(state["engine_is_running"])
+        state["air_temperature"] = state.pop("target_climate_temperature")
+        # the log does not keep the remaining charge time: assume ~10%/h up to the AC limit
+        state["charge_duration_minutes"] = 0
+        if state["charging"]:
+            state["charge_duration_minutes"] = max(((state["ac_charge_limit_percent"] or 100)
+                                                    - (state["battery_percentage"] or 0)) * 6, 1)
+
+        return state
+
+
+class ReplayApi(ApiImpl):
+    """
+    Stand-in for the region API implementation of the library
+    Role:
+    - answer from a replay source at the virtual time
+    - count the upstream calls, per method and per (virtual) day
+    """
+
+    def __init__(self, source: ReplaySource, clock: VirtualClock):
+        super().__init__()
+        self.source = source
+        self.clock = clock
+
+        self.calls = collections.Counter()  # method -> calls
+        self.calls_per_day = collections.Counter()  # date -> calls
+        self.budgeted_calls_per_day = collections.Counter()  # date -> calls counted against the daily API budget
+
+        # made by the library when the account logs in, without VehicleClient.spend_api_call()
+        self.UNBUDGETED_METHODS = ("login", "get_vehicles")
+
+    def count_call(self, method: str):
+        self.calls[method] += 1
+        self.calls_per_day[self.clock.now.date()] += 1
+        if method not in self.UNBUDGETED_METHODS:
+            self.budgeted_calls_per_day[self.clock.now.date()] += 1
+
+    def login(self, username: str, password: str, pin: str = None) -> Token:
+        self.count_call("login")
+        return Token(username=username, password=password, access_token="replay", refresh_token="replay",
+                     valid_until=datetime.datetime.max.replace(tzinfo=datetime.timezone.utc), pin=pin)
+
+    def get_vehicles(self, token: Token) -> list:
+        self.count_call("get_vehicles")
+        return [Vehicle(id=REPLAY_VEHICLE_ID, name="replay", model="replay")]
+
+    def update_vehicle_with_cached_state(self, token: Token, vehicle: Vehicle):
+        self.count_call("update_vehicle_with_cached_state")
+        self._update_vehicle_properties(vehicle, self.source.get_cached_state(self.clock.get_timestamp()))
+
+    def _get_cached_vehicle_state(self, token: Token, vehicle: Vehicle) -> tuple:
+        self.count_call("get_cached_vehicle_state")
+        return self.source.get_cached_state(self.clock.get_timestamp())
+
+    @staticmethod
+    def _update_vehicle_properties(vehicle: Vehicle, cached_state: tuple):
+        unix_timestamp, state = cached_state
+        # the library returns timezone aware local times
+        updated_at = datetime.datetime.fromtimestamp(unix_timestamp).astimezone()
+
+        vehicle.last_updated_at = updated_at
+        vehicle.ev_battery_percentage = state["battery_percentage"]
+        vehicle.car_battery_percentage = state["accessory_battery_percentage"]
+        vehicle.ev_driving_range = (state["estimated_range_km"], "km")
+        vehicle.odometer = (state["odometer"], "km")
+        vehicle.location = (state["latitude"], state["longitude"], updated_at)
+        vehicle.ev_battery_is_charging = state["charging"]
+        vehicle.engine_is_running = state["engine_is_running"]
+        vehicle.ev_charge_limits_ac = state["ac_charge_limit_percent"]
+        vehicle.ev_charge_limits_dc = state["dc_charge_limit_percent"]
+        vehicle.ev_estimated_current_charge_duration = (state["charge_duration_minutes"], "m")
+        vehicle.air_temperature = (state["air_temperature"], "C")
+        vehicle.data = state
+
+    def force_refresh_vehicle_state(self, token: Token, vehicle: Vehicle):
+        self.count_call("force_refresh_vehicle_state")
+        self.source.force_refresh(self.clock.get_timestamp())
+
+    def _get_driving_info(self, token: Token, vehicle: Vehicle) -> list:
+        self.count_call("get_driving_info")
+        return self.source.get_daily_stats(self.clock.get_timestamp())
+
+    @staticmethod
+    def _update_vehicle_drive_info(vehicle: Vehicle, daily_stats: list):
+        vehicle.daily_stats = daily_stats
+
+    def update_month_trip_info(self, token: Token, vehicle: Vehicle, yyyymm_string: str):
+        self.count_call("update_month_trip_info")
+        vehicle.month_trip_info = MonthTripInfo(yyyymm=yyyymm_string,
+                                                day_list=self.source.get_trip_days(yyyymm_string,
+                                                                                   self.clock.get_timestamp()))
+
+    def update_day_trip_info(self, token: Token, vehicle: Vehicle, yyyymmdd_string: str):
+        self.count_call("update_day_trip_info")
+        vehicle.day_trip_info = DayTripInfo(yyyymmdd=yyyymmdd_string,
+                                            trip_list=self.source.get_trips(yyyymmdd_string,
+                                                                            self.clock.get_timestamp()))
+
+
+class ReplayHarness:
+    """
+    Throughput harness for VehicleClient.refresh()
+    Role:
+    - run the daemon cycle (one run of main.py: new VehicleClient, then refresh()) against a replay source,
+      on a virtual clock and a fresh database
+    - measure upstream calls, database rows written, wall time per cycle and peak memory
+
+    Only the upstream API and the clock are replaced: the database layer, the poll scheduler, trip processing,
+    analytics and predictions all run for real.
+    """
+
+    def __init__(self, source: ReplaySource, db_path: str, cycle_interval: int = 600, daily_api_budget: int = 200,
+                 trace_memory: bool = True):
+        """
+        :param db_path: database to create. must not exist
+        :param cycle_interval: seconds between two daemon runs (cron interval)
+        :param trace_memory: trace allocations with tracemalloc. slows cycles down
+        """
+        self.source = source
+        self.db_path = db_path
+        self.cycle_interval = cycle_interval
+        self.daily_api_budget = daily_api_budget
+        self.trace_memory = trace_memory
+
+        self.clock = VirtualClock(source.start)
+        self.api = ReplayApi(source, self.clock)
+
+        # connections opened by the database client during the current cycle
+        self.connections: list = []
+        self.rows_written = 0
+
+    def create_database(self):
+        if os.path.exists(self.db_path):
+            raise FileExistsError(f"database already exists: {self.db_path}")
+
+        conn = sqlite3.connect(self.db_path)
+        with open(SCHEMA_PATH) as schema_file:
+            conn.executescript(schema_file.read())
+        conn.close()
+
+        os.environ["KIA_DB_PATH"] = self.db_path
+
+    @contextlib.contextmanager
+    def count_rows_written(self):
+        """
+        Sums the total_changes (rows inserted, updated or deleted, triggers included) of the connections opened by
+        DatabaseClient when they are closed. The ones it leaves open are kept, to be closed after each cycle
+        """
+        connect = sqlite3.connect
+        harness = self
+
+        class CountingConnection(sqlite3.Connection):
+            def close(self):
+                try:
+                    harness.rows_written += self.total_changes
+                except sqlite3.ProgrammingError:
+                    # already closed
+                    pass
+                super().close()
+
+        def counting_connect(*args, **kwargs):
+            conn = connect(*args, factory=CountingConnection, **kwargs)
+            self.connections.append(conn)
+            return conn
+
+        sqlite3_module = types.ModuleType("sqlite3")
+        sqlite3_module.__dict__.update(sqlite3.__dict__)
+        sqlite3_module.connect = counting_connect
+
+        DatabaseClient.sqlite3 = sqlite3_module
+        try:
+            yield
+        finally:
+            DatabaseClient.sqlite3 = sqlite3
+
+    def run_cycle(self):
+        account = Account(name=REPLAY_ACCOUNT, username=REPLAY_ACCOUNT, password=REPLAY_ACCOUNT,
+                          daily_api_budget=self.daily_api_budget)
+        account.vm.api = self.api
+
+        vehicle_client = VehicleClient.VehicleClient(account=account, vehicle_id=REPLAY_VEHICLE_ID)
+        vehicle_client.logger = logger.getChild("vehicle")
+        vehicle_client.interval_in_seconds = vehicle_client.CACHED_REFRESH_INTERVAL
+        vehicle_client.refresh()
+
+    def run(self) -> dict:
+        self.create_database()
+
+        cycle_times = []
+        self.rows_written = 0
+        errors = collections.Counter()
+        first_tracebacks = {}
+        memory_after_first_cycle = 0
+
+        if self.trace_memory:
+            tracemalloc.start()
+
+        started_at = time.perf_counter()
+
+        # the daemon prints every SQL statement and logs every step: silence it
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(self.clock.install())
+            stack.enter_context(self.count_rows_written())
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            logging.disable(logging.CRITICAL)
+            try:
+                while self.clock.now + datetime.timedelta(seconds=self.cycle_interval) <= self.source.end:
+                    self.clock.advance(self.cycle_interval)
+
+                    cycle_started_at = time.perf_counter()
+                    try:
+                        self.run_cycle()
+                    except Exception as e:
+                        errors[type(e).__name__] += 1
+                        first_tracebacks.setdefault(type(e).__name__, traceback.format_exc())
+                    cycle_times.append(time.perf_counter() - cycle_started_at)
+
+                    for conn in self.connections:
+                        conn.close()
+                    self.connections.clear()
+
+                    if self.trace_memory and len(cycle_times) == 1:
+                        memory_after_first_cycle = tracemalloc.get_traced_memory()[0]
+            finally:
+                logging.disable(logging.NOTSET)
+
+        wall_time = time.perf_counter() - started_at
+
+        memory = {}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            memory = {"peak_bytes": peak, "growth_bytes": current - memory_after_first_cycle}
+
+        for error, formatted_traceback in first_tracebacks.items():
+            logger.error(f"{errors[error]} cycles failed with {error}, first traceback:\n{formatted_traceback}")
+
+        return self.get_report(cycle_times, wall_time, self.rows_written, errors, memory)
+
+    def get_report(self, cycle_times: list, wall_time: float, rows_written: int, errors: collections.Counter,
+                   memory: dict) -> dict:
+        conn = sqlite3.connect(self.db_path)
+        cur = conn.cursor()
+
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name;")
+        table_rows = {table: cur.execute(f'SELECT COUNT(*) FROM "{table}";').fetchone()[0]
+                      for (table,) in cur.fetchall()}
+
+        conn.close()
+
+        # from the calls actually served
+        budgeted_calls_per_day = self.api.budgeted_calls_per_day.values()
+
+        simulated_seconds = len(cycle_times) * self.cycle_interval
+        simulated_days = simulated_seconds / 86400
+        times_ms = np.array(cycle_times) * 1000
+
+        return {"simulated_days": round(simulated_days, 1),
+                "cycles": len(cycle_times),
+                "cycle_interval_seconds": self.cycle_interval,
+                "wall_time_seconds": round(wall_time, 2),
+                "speedup": round(simulated_seconds / wall_time) if wall_time else None,
+                "cycle_wall_time_ms": {"mean": round(float(times_ms.mean()), 2),
+                                       "median": round(float(np.median(times_ms)), 2),
+                                       "p95": round(float(np.percentile(times_ms, 95)), 2),
+                                       "max": round(float(times_ms.max()), 2)} if len(times_ms) else {},
+                "upstream_calls": {"total": sum(self.api.calls.values()),
+                                   "per_day_mean": round(sum(self.api.calls.values()) / simulated_days, 1)
+                                   if simulated_days else None,
+                                   "per_day_max": max(self.api.calls_per_day.values(), default=0),
+                                   "per_method": dict(self.api.calls.most_common())},
+                "api_budget": {"daily_budget": self.daily_api_budget,
+                               "budgeted_calls": sum(budgeted_calls_per_day),
+                               "max_budgeted_calls_per_day": max(budgeted_calls_per_day, default=0),
+                               "days_over_budget": sum(1 for calls in budgeted_calls_per_day
+                                                       if calls > self.daily_api_budget)},
+                "db": {"rows_written": rows_written,
+                       "rows_written_per_cycle": round(rows_written / len(cycle_times), 1) if cycle_times else None,
+                       "size_bytes": os.path.getsize(self.db_path),
+                       "table_rows": table_rows},
+                "memory": memory,
+                "errors": dict(errors)}
+
+
+def log_report(report: dict):
+    cycle_times = report["cycle_wall_time_ms"]
+    calls = report["upstream_calls"]
+    budget = report["api_budget"]
+    db = report["db"]
+
+    logger.info(f"{report['cycles']} cycles, {report['simulated_days']} simulated days in "
+                f"{report['wall_time_seconds']} s (x{report['speedup']})")
+    if cycle_times:
+        logger.info(f"wall time per cycle: mean {cycle_times['mean']} ms, median {cycle_times['median']} ms, "
+                    f"p95 {cycle_times['p95']} ms, max {cycle_times['max']} ms")
+    logger.info(f"upstream calls: {calls['total']} ({calls['per_day_mean']}/day on average, "
+                f"{calls['per_day_max']} at most). per method: {calls['per_method']}")
+    logger.info(f"API budget: {budget['budgeted_calls']} budgeted calls, at most {budget['max_budgeted_calls_per_day']} "
+                f"a day for a budget of {budget['daily_budget']}. {budget['days_over_budget']} days over budget")
+    logger.info(f"DB: {db['rows_written']} rows written ({db['rows_written_per_cycle']}/cycle), "
+                f"{db['size_bytes'] / 1024 / 1024:.1f} MiB. rows per table: "
+                f"{ {table: rows for table, rows in db['table_rows'].items() if rows} }")
+    if report["memory"]:
+        logger.info(f"memory: peak {report['memory']['peak_bytes'] / 1024 / 1024:.1f} MiB, "
+                    f"{report['memory']['growth_bytes'] / 1024:.0f} KiB growth after the first cycle")
+    if report["errors"]:
+        logger.warning(f"failed cycles: {report['errors']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay months of polling through VehicleClient.refresh() on a "
+                                                 "virtual clock, against synthetic or recorded vehicle data, and "
+                                                 "report upstream calls, DB rows written, time per cycle and memory.")
+
+    parser.add_argument("--recorded", help="database to replay the log, trips and daily stats of. "
+                                           "default: simulated vehicle")
+    parser.add_argument("--vehicle-id", help="vehicle to replay from the recorded database. default: all rows")
+    parser.add_argument("--days", type=int, default=365, help="simulated days (synthetic data). default: 365")
+    parser.add_argument("--start", default="2024-01-01", help="first simulated day (synthetic data). "
+                                                              "default: 2024-01-01")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the simulated vehicle")
+    parser.add_argument("--cycle-minutes", type=int, default=10, help="minutes between two daemon runs. default: 10")
+    parser.add_argument("--daily-api-budget", type=int, default=200)
+    parser.add_argument("--db", help="database written by the replay, kept afterwards. must not exist. "
+                                     "default: temporary database")
+    parser.add_argument("--no-tracemalloc", action="store_true",
+                        help="do not trace memory allocations: cycle times are not slowed down by tracing")
+    parser.add_argument("--json", action="store_true", help="also print the report as JSON")
+    args = parser.parse_args()
+
+    if args.recorded:
+        replay_source = RecordedSource(args.recorded, args.vehicle_id)
+    else:
+        replay_source = SyntheticSource(datetime.datetime.strptime(args.start, "%Y-%m-%d"), args.days, args.seed)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        harness = ReplayHarness(replay_source,
+                                db_path=args.db or os.path.join(temp_dir, "replay.db"),
+                                cycle_interval=args.cycle_minutes * 60,
+                                daily_api_budget=args.daily_api_budget,
+                                trace_memory=not args.no_tracemalloc)
+        replay_report = harness.run()
+
+    log_report(replay_report)
+    if args.json:
+        print(json.dumps(replay_report, indent=2))